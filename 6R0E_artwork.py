@@ -28,11 +28,38 @@ import subprocess
 import pymol
 import argparse
 import itertools
+import tempfile
+import json
+import traceback
+import multiprocessing
+import hashlib
+import shutil
+import gzip
+import fcntl
+import urllib2
+import math
+import uuid
+import resource
+import struct
+import zlib
+import threading
+import socket
+import signal
+import SocketServer
+import collections
+import multiprocessing.pool
+import contextlib
+import cProfile
+import fnmatch
 
 import matplotlib
+# no windows are ever opened so use the non-interactive backend. This lets headless batch workers draw the canvas too.
+matplotlib.use("Agg")
 
 import matplotlib.pyplot as plt
 import matplotlib.image as mpimg
+import matplotlib.colors
+import numpy as np
 
 ######## SOME DEFAULT SETTINGS AT THE TOP FOR EASY ACCESS ########
 
@@ -46,6 +73,8 @@ colourSet =     {   'top'      :   '#acc4ce',
                     'TCRB'     :   '#306b64'
                  }
 
+# each role is given as chain ids, e.g. "AAA" or "A,B", which can have wildcards "A*",
+# or as "entity:1" or "type:polypeptide(L)" for every chain of an entity or entity type in the mmcif file. See match_chains().
 chains_dict =   {   "HLAA"     :    "AAA",
                     "HLAB"     :    "BBB",
                     "peptide"  :    "CCC",
@@ -53,6 +82,154 @@ chains_dict =   {   "HLAA"     :    "AAA",
                     "TCRB"     :    "EEE"
                 }      
 
+# surfaces are given some transparency so the HLA helices and peptide show through
+transparencySet = { "HLAA"     :    0.1,
+                    "HLAB"     :    0.1,
+                    "peptide"  :    0.1,
+                    "TCRA"     :    0.0,
+                    "TCRB"     :    0.0
+                }
+
+# every chain object is shown as a surface, add extra representations here
+representationSet = { "peptide" :   ["surface", "sticks"] }
+
+entry_id = "6r0e"
+
+complex_view = ("\
+    -0.194591478,    0.968047142,   -0.158180326,\
+    -0.116970502,   -0.183013782,   -0.976128042,\
+    -0.973888516,   -0.171443373,    0.148845106,\
+     0.000085423,    0.000001311, -432.039001465,\
+   -35.504920959,   24.705741882,  -28.177782059,\
+   377.880249023,  486.194641113,   20.000000000")
+
+# views that can be rendered with --views. A view is a PyMOL view, or another named view turned about a screen axis by some degrees.
+named_views = { "complex"  :   complex_view,
+                "side"     :   {"from" : "complex", "turn" : ["y", 90.0]},
+                "top"      :   {"from" : "complex", "turn" : ["x", 90.0]}
+              }
+
+# sizes of the structure layer that can be rendered with --sizes. The poster size is also made into the canvas.
+output_sizes = {    "poster"    :   {"width" : "20cm",  "height" : "30cm",  "dpi" : 300,    "canvas" : True},
+                    "slide"     :   {"width" : 1920,    "height" : 1080,    "dpi" : 150,    "canvas" : False},
+                    "square"    :   {"width" : 1080,    "height" : 1080,    "dpi" : 150,    "canvas" : False},
+                    "thumbnail" :   {"width" : 256,     "height" : 256,     "dpi" : 72,     "canvas" : False}
+               }
+# the quick draft rendered first with --views/--sizes, also with --no_ray. Width in pixels, the height keeps the poster shape.
+draft_width = 400
+
+# my favourite PyMOL parameters for making figures, applied in order by initialisePymol()
+pymol_settings = [  ("ray_shadows",             "0"),
+                    ("specular",                "off"),
+                    ("orthoscopic",             "on"),
+                    ("bg_rgb",                  "white"),
+                    ("valence",                 0),
+                    ("ray_opaque_background",   "0"),
+                    ("ray_trace_mode",          1),
+                    ("transparency_mode",       2),
+                    ("dash_round_ends",         0)
+                 ]
+
+# size of the ray traced structure layer
+image_width = "20cm"
+image_height = "30cm"
+image_dpi = 300
+
+# the canvas is an A3 page. The structure layer is placed this many pixels from the bottom left and the background is split this far up.
+page_size = (11.7, 16.5)
+page_dpi = 300
+structure_offset = (600, 1000)
+band_split = 0.33
+# "numpy" blends the layers straight into an array, "matplotlib" draws the whole page as a figure
+canvas_compositor = "numpy"
+# the plaque title and authors are wrapped to this fraction of the page width, measured with the real widths of the glyphs
+plaque_width = 0.5
+
+# formats the canvas is written in and the settings for each. The jpeg is a small preview.
+output_formats = ["png", "pdf"]
+output_settings = { "png"   :   {},
+                    "pdf"   :   {},
+                    "tiff"  :   {"suffix" : ".tiff", "compression" : "tiff_deflate"},
+                    "webp"  :   {"suffix" : ".webp", "quality" : 90, "method" : 4},
+                    "jpeg"  :   {"suffix" : "_preview.jpg", "quality" : 85, "thumbnail" : 1024},
+                    "bigtiff":  {"suffix" : "_tiled.tiff", "compression" : "tiff_deflate", "tile" : 512}
+                  }
+
+# png, pdf and tiff compression. The png rows are filtered with "none", "sub", "up", "avg", "paeth" or "adaptive" (the best of them for each row)
+# and deflated in chunks of encode_chunk_rows rows by encode_threads threads. draft is quick for trying things out, archival is slow and small.
+encode_modes = {    "draft"     :   {"level" : 1,   "filter" : "up",        "strategy" : zlib.Z_DEFAULT_STRATEGY},
+                    "default"   :   {"level" : 6,   "filter" : "up",        "strategy" : zlib.Z_DEFAULT_STRATEGY},
+                    "archival"  :   {"level" : 9,   "filter" : "adaptive",  "strategy" : zlib.Z_FILTERED}
+               }
+encode_mode = "default"
+encode_threads = multiprocessing.cpu_count()
+encode_chunk_rows = 256
+
+# with --strips the canvas is composed and written strip_rows rows at a time and the structure layer is decoded or ray traced into a memmap,
+# so the memory used depends on the strip size rather than the page size. Only png, pdf, tiff and bigtiff can be written this way.
+strip_output = False
+strip_rows = 256
+
+# tiled rendering splits the structure layer into tiles of tile_size pixels which are ray traced in parallel by tile_workers PyMOL processes.
+# Each tile is rendered tile_overlap pixels too big on every side and cropped, so antialiasing at the tile edges matches the single-shot render.
+tile_size = 512
+tile_overlap = 8
+tile_workers = multiprocessing.cpu_count()
+
+# PyMOL only hands over a ray traced image as a file, so renders which are only needed as arrays are written to a RAM backed directory when there is one
+ray_temp_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+# ray traced structure layers are cached here, keyed by everything which changes the render. Size limit in MB.
+render_cache_dir = ".render_cache"
+render_cache_size = 2048
+
+# local store of mmCIF files so runs work offline. Structures are only downloaded from RCSB when they are not in the store.
+structure_store_dir = "structure_store"
+structure_store_gzip = True
+structure_url = "https://files.rcsb.org/download/%s.cif.gz"
+offline = False
+
+# animations are frames_per_second x frames long and drawn at animation_dpi, much smaller than the print canvas.
+# "turntable" turns the camera a full circle about animation_axis, "flythrough" moves through animation_keyframes and back.
+animation_frames = 120
+animation_fps = 30
+animation_dpi = 72
+animation_axis = "y"
+animation_keyframes = [ lambda view: zoom_view(view, 0.4, "y", 90.0),
+                        lambda view: zoom_view(view, 0.2, "x", -45.0)
+                      ]
+animation_format = "mp4"
+animation_settings = {  "mp4"   :   {"suffix" : ".mp4", "codec" : ["-c:v", "libx264", "-pix_fmt", "yuv420p", "-crf", "18"]},
+                        "webp"  :   {"suffix" : ".webp", "codec" : ["-c:v", "libwebp", "-quality", "85", "-loop", "0"]}
+                     }
+# frames being rendered or waiting to be encoded at any one time, this bounds the memory used
+animation_window = 2 * multiprocessing.cpu_count()
+ffmpeg_binary = "ffmpeg"
+
+# level of detail. Without --detail or --budget the "default" level is used, which is PyMOL's own settings.
+# With --budget (or --detail auto) the finest level which is still within render_budget seconds is used, going no finer than is visible at the pixel size:
+# a level is fine enough once its feature size (in angstroms) covers no more than detail_pixels pixels.
+# The estimate is surface_seconds per 1000 atoms plus ray_seconds per megapixel per decade of atoms, a rough model to tune from --profile reports.
+render_budget = 300
+detail_pixels = 4
+detail_level = "default"
+detail_levels = [   {"name" : "high",       "feature" : 0.25,   "surface_seconds" : 0.5,    "ray_seconds" : 6.0,
+                     "settings" : [("surface_quality", 1), ("solvent_radius", 1.4), ("cartoon_sampling", 14), ("antialias", 2)]},
+                    {"name" : "default",    "feature" : 0.5,    "surface_seconds" : 0.2,    "ray_seconds" : 4.0,
+                     "settings" : [("surface_quality", 0), ("solvent_radius", 1.4), ("cartoon_sampling", -1), ("antialias", 1)]},
+                    {"name" : "medium",     "feature" : 1.0,    "surface_seconds" : 0.06,   "ray_seconds" : 3.0,
+                     "settings" : [("surface_quality", -1), ("solvent_radius", 1.6), ("cartoon_sampling", 5), ("antialias", 1)]},
+                    {"name" : "low",        "feature" : 2.0,    "surface_seconds" : 0.02,   "ray_seconds" : 2.0,
+                     "settings" : [("surface_quality", -2), ("solvent_radius", 2.0), ("cartoon_sampling", 3), ("antialias", 1)]}
+                ]
+
+# seconds to wait for PyMOL to finish writing a ray traced image before giving up
+ray_timeout = 3600
+
+# every png starts with this signature and ends with the IEND chunk
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+PNG_IEND = '\x00\x00\x00\x00IEND\xaeB`\x82'
+
 #########################################################################################
 ###########################      ARGUMENT PARSER      ###################################
 #########################################################################################
@@ -64,11 +241,95 @@ def parse_args():
     parser.add_argument('--no_ray', dest = 'do_ray',   action='store_false', required = False, help ='Do you want to render and save images? Add flag to generate no images (quicker).')
     parser.add_argument('--view', dest = 'do_view',   action='store_true', required = False, help ='Do you want to view the pymol session on end? Add flag to leave open at end.')
 
+    parser.add_argument('--ray_timeout', dest = 'ray_timeout', action='store', type=float, required = False, help ='Seconds to wait for PyMOL to finish writing the ray traced image before giving up.')
     parser.add_argument('--palette', dest = 'palette', action='store', required = False, help='Supply a colour palette of the palettable library. example input is palettable.wesanderson.Darjeeling3_5. See https://jiffyclub.github.io/palettable/')
 
+    parser.add_argument('--tiles', dest = 'tiles', action='store_true', required = False, help='Ray trace the structure layer as tiles in parallel worker processes and stitch them together. Much faster for poster-size renders.')
+    parser.add_argument('--tile_size', dest = 'tile_size', action='store', type=int, required = False, help='Size of each tile in pixels for --tiles.')
+    parser.add_argument('--tile_workers', dest = 'tile_workers', action='store', type=int, required = False, help='Number of PyMOL processes used by --tiles. Defaults to the number of cores.')
+    parser.add_argument('--tile_check', dest = 'tile_check', action='store_true', required = False, help='Also do the single-shot render and report how far the tiled render is from it.')
+
+    parser.add_argument('--cache_dir', dest = 'cache_dir', action='store', required = False, help='Directory of cached ray traced structure layers. A rerun with nothing changed reuses the cached render.')
+    parser.add_argument('--cache_size', dest = 'cache_size', action='store', type=float, required = False, help='Size limit of the render cache in MB, shared by the renders, warm start sessions and plaque layers. The least recently used files are removed first.')
+    parser.add_argument('--warm_start', dest = 'warm_start', action='store_true', required = False, help='Restore the scene, with its surfaces, from a session cached in the render cache and skip straight to the ray trace.')
+    parser.add_argument('--no_cache', dest = 'cache_dir', action='store_const', const=None, required = False, help='Always ray trace, do not read or write the render cache.')
+
+    parser.add_argument('--store', dest = 'store', action='store', required = False, help='Directory of the local structure store. Entries are read from here and only downloaded if missing.')
+    parser.add_argument('--offline', dest = 'offline', action='store_true', required = False, help='Never download structures. Fail if an entry is not in the local structure store.')
+    parser.add_argument('--store_add', dest = 'store_add', action='store', nargs='+', required = False, help='Add mmCIF files (optionally .gz) to the local structure store and exit. The entry id is taken from the file name.')
+
+    parser.add_argument('--masks', dest = 'masks', action='store_true', required = False, help='Ray trace a chain id mask and a shading layer once and colour the structure from them. New colours then need no ray trace.')
+    parser.add_argument('--explore', dest = 'explore', action='store', type=int, required = False, help='With --palette, recolour the masks with up to this many combinations of the palette colours and save a preview of each.')
+
+    parser.add_argument('--compositor', dest = 'compositor', action='store', choices=["numpy", "matplotlib"], required = False, help='How the canvas is drawn. numpy blends the layers into an array, matplotlib draws the page as a figure.')
+    parser.add_argument('--formats', dest = 'formats', action='store', required = False, help='Comma separated formats to write the canvas in, from png, pdf, tiff, bigtiff (tiled), webp and jpeg (a small preview). They are written at the same time from one drawing.')
+    parser.add_argument('--encode', dest = 'encode', action='store', choices=sorted(encode_modes), required = False, help='How hard the png, pdf and tiff outputs are compressed: draft is quick, archival is small. The time and size of each file is printed.')
+    parser.add_argument('--encode_threads', dest = 'encode_threads', action='store', type=int, required = False, help='Threads used to compress the outputs. Defaults to the number of cores.')
+    parser.add_argument('--strips', dest = 'strips', action='store_true', required = False, help='Compose and write the canvas a strip at a time so memory does not grow with the page size. For very large prints, png, pdf, tiff and bigtiff only.')
+    parser.add_argument('--strip_rows', dest = 'strip_rows', action='store', type=int, required = False, help='Rows in each strip with --strips.')
+    parser.add_argument('--compare_canvas', dest = 'compare_canvas', action='store_true', required = False, help='Draw the canvas with both compositors and report their time, peak memory and how far apart they are.')
+
+    parser.add_argument('--daemon', dest = 'daemon', action='store', required = False, help='Run as a render daemon listening for jobs on this Unix socket, with --workers PyMOL workers kept warm.')
+    parser.add_argument('--queue_size', dest = 'queue_size', action='store', type=int, required = False, help='Number of jobs the daemon lets wait for a worker before turning more away as busy.')
+    parser.add_argument('--client', dest = 'client', action='store', required = False, help='Send this run to the render daemon on this Unix socket instead of starting PyMOL.')
+    parser.add_argument('--stats', dest = 'stats', action='store_true', required = False, help='With --client, print the queue depth and job timings of the daemon.')
+
+    parser.add_argument('--budget', dest = 'budget', action='store', type=float, required = False, help='Target render time in seconds. The level of detail of the surfaces, cartoons and ray tracing is picked from the atom count and pixel size to fit it. Without this or --detail PyMOL\'s own settings are used.')
+    parser.add_argument('--detail', dest = 'detail', action='store', choices=['auto']+[level["name"] for level in detail_levels], required = False, help='Level of detail to render at. auto picks one from the atom count, pixel size and --budget (300 seconds unless given). Defaults to auto with --budget and to default, PyMOL\'s own settings, without.')
+
+    parser.add_argument('--profile', dest = 'profile', action='store_true', required = False, help='Record the wall time, CPU time and peak memory of every stage and write them next to the canvas as json.')
+    parser.add_argument('--profile_dump', dest = 'profile_dump', action='store_true', required = False, help='With --profile, also dump a cProfile of each stage into a profile directory next to the canvas.')
+
+    parser.add_argument('--animate', dest = 'animate', action='store', choices=['turntable', 'flythrough'], required = False, help='Make a turntable or fly-through animation of the artwork instead of the canvas. Frames are ray traced by --workers PyMOL processes.')
+    parser.add_argument('--frames', dest = 'frames', action='store', type=int, required = False, help='Number of frames in the animation.')
+    parser.add_argument('--animation_format', dest = 'animation_format', action='store', choices=['mp4', 'webp'], required = False, help='Encode the animation as an mp4 video or an animated webp.')
+
+    parser.add_argument('--views', dest = 'views', action='store', required = False, help='Comma separated named views to render from one loaded scene, from '+", ".join(sorted(named_views))+'. Used with --sizes.')
+    parser.add_argument('--sizes', dest = 'sizes', action='store', required = False, help='Comma separated sizes to render each of --views at, from '+", ".join(sorted(output_sizes))+'. A quick draft is always rendered first.')
+
+    parser.add_argument('--batch', dest = 'batch', action='store', required = False, help='Supply a json manifest of PDB entries to generate artwork for many entries at once. See run_batch() for the format.')
+    parser.add_argument('--workers', dest = 'workers', action='store', type=int, required = False, help='Number of headless PyMOL workers used by --batch, --animate and --views. Defaults to the number of cores.')
+    parser.add_argument('--outdir', dest = 'outdir', action='store', required = False, help='Directory that --batch, --daemon and --client write one sub-directory of outputs per entry into, and --animate and --views write into.')
+
     parser.set_defaults(do_ray=False)
     parser.set_defaults(do_view=False)
     parser.set_defaults(palette=None)
+    parser.set_defaults(ray_timeout=ray_timeout)
+    parser.set_defaults(tiles=False)
+    parser.set_defaults(tile_size=tile_size)
+    parser.set_defaults(tile_workers=tile_workers)
+    parser.set_defaults(tile_check=False)
+    parser.set_defaults(cache_dir=render_cache_dir)
+    parser.set_defaults(cache_size=render_cache_size)
+    parser.set_defaults(warm_start=False)
+    parser.set_defaults(store=structure_store_dir)
+    parser.set_defaults(offline=offline)
+    parser.set_defaults(store_add=None)
+    parser.set_defaults(masks=False)
+    parser.set_defaults(explore=None)
+    parser.set_defaults(compositor=canvas_compositor)
+    parser.set_defaults(compare_canvas=False)
+    parser.set_defaults(formats=",".join(output_formats))
+    parser.set_defaults(daemon=None)
+    parser.set_defaults(queue_size=16)
+    parser.set_defaults(client=None)
+    parser.set_defaults(stats=False)
+    parser.set_defaults(encode=encode_mode)
+    parser.set_defaults(encode_threads=encode_threads)
+    parser.set_defaults(strips=False)
+    parser.set_defaults(strip_rows=strip_rows)
+    parser.set_defaults(budget=None)
+    parser.set_defaults(detail=None)
+    parser.set_defaults(profile=False)
+    parser.set_defaults(profile_dump=False)
+    parser.set_defaults(animate=None)
+    parser.set_defaults(frames=animation_frames)
+    parser.set_defaults(animation_format=animation_format)
+    parser.set_defaults(views=None)
+    parser.set_defaults(sizes=None)
+    parser.set_defaults(batch=None)
+    parser.set_defaults(workers=multiprocessing.cpu_count())
+    parser.set_defaults(outdir="batch_output")
     
     args = parser.parse_args()
     return args
@@ -77,62 +338,385 @@ def parse_args():
 ###############################      FUNCTIONS      #####################################
 #########################################################################################
 
+######## Profiling ############
+
+# The stage names recorded by profile_stage(). Dashboards track these across releases, so only ever add to this list.
+pipeline_stages = [ "pymol.init",           # launching or reinitialising PyMOL
+                    "structure.fetch",      # getting the entry from the structure store, or downloading it
+                    "metadata.parse",       # reading the mmcif header for the plaque
+                    "cache.lookup",         # hashing the render inputs and looking in the render cache
+                    "cache.read",           # reading a cached render
+                    "scene.restore",        # warm start from a cached session
+                    "structure.load",       # loading the mmcif file into PyMOL
+                    "chains.setup",         # selecting, colouring and creating the chain objects
+                    "structure.surfaces",   # showing the representations and building the surfaces
+                    "scene.store",          # saving the scene for warm starts
+                    "structure.ray",        # ray tracing the structure layer
+                    "structure.masks",      # ray tracing the id mask and shading layer and recolouring
+                    "cache.store",          # copying the render into the render cache
+                    "canvas.compose",       # drawing the canvas
+                    "canvas.write",         # encoding and writing the output formats
+                    "session.save",         # saving the PyMOL session
+                    "canvas.prepare",       # drawing the background and plaque layers, in a thread while the structure is rendered
+                    "canvas.wait"           # waiting for canvas.prepare to finish after the render
+                  ]
+profile_schema = 1
+
+# set by --profile and --profile_dump
+profiling = False
+profile_dumps = False
+
+profile_records = []
+# stages can run in more than one thread, each thread keeps its own nesting depth
+profile_local = threading.local()
+profile_start = time.time()
+profile_dump_dir = None
+
+# the detail_policy() report of the last scene prepared, added to the profile report
+detail_report = None
+# the time and size of every file written by write_outputs(), see report_encoder()
+encoder_reports = []
+
+def start_profile(dump_dir):
+    '''
+    Clears the stage records, ready for a new entry. cProfile dumps go into dump_dir if --profile_dump was given.
+    '''
+    global profile_records, profile_start, profile_dump_dir, detail_report, encoder_reports
+    profile_records = []
+    detail_report = None
+    encoder_reports = []
+    profile_start = time.time()
+    profile_dump_dir = dump_dir if profile_dumps else None
+    return None
+
+@contextlib.contextmanager
+def profile_stage(name):
+    '''
+    Records the wall time, CPU time and peak RSS of a stage of the pipeline, see pipeline_stages for the names.
+    CPU time and peak RSS are for this process, work done by tile or batch worker processes is only seen in the wall time.
+    With --profile_dump the outermost stages are also run under cProfile and dumped to <stage>.prof.
+    Stages running in other threads are recorded with the name of their thread, their CPU time overlaps the main thread's.
+    '''
+    depth = getattr(profile_local, "depth", 0)
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    profiler = None
+    if profile_dump_dir != None and depth == 0:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    profile_local.depth = depth + 1
+    try:
+        yield
+    finally:
+        profile_local.depth = depth
+        if profiler != None:
+            profiler.disable()
+            if not os.path.isdir(profile_dump_dir):
+                os.makedirs(profile_dump_dir)
+            profiler.dump_stats(os.path.join(profile_dump_dir, name+".prof"))
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        profile_records.append({    "stage"             :   name,
+                                    "depth"             :   depth,
+                                    "thread"            :   threading.current_thread().name,
+                                    "start_seconds"     :   start - profile_start,
+                                    "wall_seconds"      :   time.time() - start,
+                                    "cpu_seconds"       :   (after.ru_utime + after.ru_stime) - (before.ru_utime + before.ru_stime),
+                                    "peak_rss_mb"       :   after.ru_maxrss / 1024.0,
+                                    "peak_rss_growth_mb":   (after.ru_maxrss - before.ru_maxrss) / 1024.0
+                               })
+
+def write_profile(file_name, pdb_id):
+    '''
+    Writes the stage records as json, in the order the stages started, with the totals for the whole run.
+    '''
+    stages = sorted(profile_records, key=lambda record: record["start_seconds"])
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    report = {  "schema"        :   profile_schema,
+                "entry"         :   pdb_id,
+                "created"       :   time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "stages"        :   stages,
+                "detail"        :   detail_report,
+                "encoders"      :   encoder_reports,
+                "total"         :   {   "wall_seconds"  :   time.time() - profile_start,
+                                        "peak_rss_mb"   :   usage.ru_maxrss / 1024.0
+                                    }
+             }
+    with open(file_name, "w") as handle:
+        json.dump(report, handle, indent=2)
+    print "Stage timings written to "+file_name
+    for record in stages:
+        print "  "*record["depth"] + "%-22s %8.2f s wall %8.2f s cpu %8.0f MB peak" % (record["stage"], record["wall_seconds"], record["cpu_seconds"], record["peak_rss_mb"])
+    return report
+
 ######## These are my standard PyMOL functions  ############
+pymol_launched = False
+
+# set by --compare_canvas
+compare_compositors = False
+
+# set by --warm_start, restore the scene from a cached session rather than building it
+warm_start = False
+
+# pool of PyMOL worker processes used for tiled rendering. Started by main() before PyMOL is launched in this process.
+render_pool = None
+tile_check = False
+
 def initialisePymol():
     '''
     Asks python to start a new pymol session and apply a set of parameters related pymol renders the molecules.
     i.e. I don't like shadows, so they are turned off.
     This helps to keep all figures consistent.
+    PyMOL is only launched once per process, calling this again just reinitialises the session. Batch workers rely on this.
     '''
+    global pymol_launched
     print "\nInitialising pymol...\n"
-    pymol.finish_launching(['pymol', '-c'])
+    if not pymol_launched:
+        pymol.finish_launching(['pymol', '-c'])
+        pymol_launched = True
     pymol.cmd.reinitialize()
     # set PyMOL parameters
-    # these are my favourite parameters for making figures
-    pymol.cmd.set("ray_shadows","0")
-    pymol.cmd.set("specular", "off")
-    pymol.cmd.set("orthoscopic", "on")
-    pymol.cmd.bg_color("white")
-    pymol.cmd.set("valence", 0)
-    pymol.cmd.set("ray_opaque_background", "0")
-    pymol.cmd.set("ray_trace_mode", 1)
-    pymol.cmd.set("transparency_mode", 2)
-    pymol.cmd.set("dash_round_ends", 0)
+    # these are my favourite parameters for making figures, see pymol_settings at the top
+    for name, value in pymol_settings:
+        pymol.cmd.set(name, value)
     return None
 
-def wait4ray(query):  
+def png_complete(query):
+    '''
+    Checks whether a png file exists and has been completely written.
+    A png starts with an 8 byte signature and ends with an IEND chunk, so a file which PyMOL is still writing fails one of the two checks.
+    '''
+    try:
+        with open(query, "rb") as handle:
+            if handle.read(8) != PNG_SIGNATURE:
+                return False
+            handle.seek(-len(PNG_IEND), os.SEEK_END)
+            return handle.read(len(PNG_IEND)) == PNG_IEND
+    except (IOError, OSError):
+        return False
+
+def wait4ray(query, timeout=None):  
     '''
     Helps with an issue in rendering PyMOL images where the script proceeds without PyMOL finishing the render job.
-    It checks every second whether the image has been created and then allows to proceed.
+    Returns as soon as the image has been completely written. Checks start every 10 ms and back off to every 0.5 seconds for long renders.
+    Raises a RuntimeError if the image is not complete after timeout seconds.
     '''
-    counter = 0
+    if timeout == None:
+        timeout = ray_timeout
+    start = time.time()
+    delay = 0.01
     spinner = itertools.cycle(['-', '/', '|', '\\'])
-    while not os.path.exists(query):
-        toWrite=spinner.next() + " Time elapsed: "+str(counter)+" seconds"
+    while not png_complete(query):
+        elapsed = time.time() - start
+        if elapsed > timeout:
+            raise RuntimeError("PyMOL did not finish writing "+query+" within "+str(timeout)+" seconds")
+        toWrite=spinner.next() + " Time elapsed: "+'%.1f' % elapsed+" seconds"
         sys.stdout.write(toWrite)  # write the next character
         sys.stdout.flush()                # flush stdout buffer (actual character display)
         sys.stdout.write(len(toWrite)*"\b")           # erase the last written chars
-        time.sleep(1)
-        counter += 1
+        time.sleep(delay)
+        delay = min(delay*2, 0.5)
     return None
 
-def rayTime(saveas, do_ray):
+def rayTime(saveas, do_ray, as_array=False, timeout=None):
     '''
     Helps with an issue in rendering PyMOL images where the script proceeds without PyMOL finishing the render job.
-    It removes any existing file of the same file name, pauses, begins the ray trace and uses wait4ray to check whether the job has been finished.
+    It removes any existing file of the same file name, begins the ray trace, waits for PyMOL to empty its command queue and uses wait4ray to check the png is complete.
+    With as_array=True the finished image is returned as an RGBA array so it can be handed straight to canvas().
+    If saveas is None the image is only wanted as an array, so it goes to a temporary file from ray_temp_name() which is removed afterwards.
+    If the render_pool has been started the image is ray traced as tiles by ray_tiled() instead, and returned whatever as_array is,
+    in a uint8 memmap with --strips.
     '''
     if do_ray == 0:
         return None
     else:
+        if timeout == None:
+            timeout = ray_timeout
+        keep = saveas != None
+        if not keep:
+            saveas = ray_temp_name()
         print "Outputting image.. This may take a few seconds.."
-        if os.path.exists(saveas):
+        if keep and os.path.exists(saveas):
             print "Removing "+saveas+" as it already exists!"
             os.remove(saveas)
-        time.sleep(5)
-        pymol.cmd.png(saveas,ray=do_ray,width="20cm",height="30cm", dpi=300)
-        wait4ray(saveas) 
-        print "Done! "+str(saveas)+ " was outputted" 
-        return None
+        image = None
+        if render_pool != None:
+            # the tiles come back as arrays, so a temporary png is not needed at all. With --strips they go into a memmap beside saveas
+            mapped_name = None
+            if strip_output:
+                handle, mapped_name = tempfile.mkstemp(suffix=".npy", prefix="complex_image_", dir=os.path.dirname(os.path.abspath(saveas)) if keep else None)
+                os.close(handle)
+            try:
+                image = ray_tiled(length_to_pixels(image_width, image_dpi), length_to_pixels(image_height, image_dpi), timeout, mapped_name)
+            finally:
+                # the memmap can still be read once its file is removed, and the disk space is given back when it is closed
+                if mapped_name != None:
+                    os.remove(mapped_name)
+            if keep:
+                mpimg.imsave(saveas, image)
+            if tile_check:
+                check_tiled_render(image, timeout)
+        else:
+            try:
+                pymol.cmd.png(saveas,ray=do_ray,width=image_width,height=image_height, dpi=image_dpi)
+                # blocks until PyMOL has worked through the png command rather than sleeping for a fixed time
+                pymol.cmd.sync(timeout)
+                wait4ray(saveas, timeout)
+                if as_array:
+                    image = plt.imread(saveas)
+            finally:
+                if not keep and os.path.exists(saveas):
+                    os.remove(saveas)
+        if keep:
+            print "Done! "+str(saveas)+ " was outputted"
+        return image
+
+def ray_temp_name():
+    '''
+    A new file name in ray_temp_dir (or the usual temporary directory) for a render which is read straight back in.
+    The file is not created, wait4ray() waits for PyMOL to write it.
+    '''
+    return os.path.join(ray_temp_dir or tempfile.gettempdir(), "artwork_"+uuid.uuid4().hex+".png")
+
+######## Tiled rendering ############
+
+def length_to_pixels(length, dpi):
+    '''
+    Converts an image length as given to pymol.cmd.png, i.e. "20cm" or 2362, into pixels the same way PyMOL does.
+    '''
+    if isinstance(length, basestring):
+        for unit, per_inch in (("cm", 2.54), ("mm", 25.4), ("in", 1.0)):
+            if length.endswith(unit):
+                return int(float(length[:-len(unit)]) * dpi / per_inch)
+        if length.endswith("px"):
+            length = length[:-2]
+        return int(float(length))
+    return int(length)
+
+def tile_view(view, width, height, box):
+    '''
+    Returns the view which renders just the box (left, top, right, bottom in pixels) of an orthoscopic width x height render.
+    In orthoscopic mode PyMOL shows a height of 2 * |camera distance| * tan(field of view / 2), so the camera is moved
+    to the middle of the box and the field of view is narrowed to the height of the box. The tile then lines up pixel for pixel with the single-shot render.
+    '''
+    view = view_to_list(view)
+    left, top, right, bottom = box
+    distance = abs(view[11])
+    pixel = 2.0 * distance * math.tan(math.radians(abs(view[17])) / 2.0) / height
+
+    # move the camera (in camera space, y is up) to the middle of the box
+    view[9] -= ((left + right) / 2.0 - width / 2.0) * pixel
+    view[10] += ((top + bottom) / 2.0 - height / 2.0) * pixel
+
+    # PyMOL only reads the last value as a field of view if it is more than 1 degree
+    fov = 2.0 * math.degrees(math.atan((bottom - top) * pixel / 2.0 / distance))
+    if fov <= 1.0:
+        raise ValueError("Tiles of "+str(bottom - top)+" pixels are too small for this view, use a bigger --tile_size")
+    view[17] = math.copysign(fov, view[17])
+    return view
+
+def tile_boxes(width, height, size, overlap):
+    '''
+    Splits a width x height image into tiles. Yields the box of each tile and the bigger box which is rendered for it.
+    Boxes are (left, top, right, bottom) in pixels.
+    '''
+    for top in xrange(0, height, size):
+        for left in xrange(0, width, size):
+            box = (left, top, min(left + size, width), min(top + size, height))
+            yield box, (box[0] - overlap, box[1] - overlap, box[2] + overlap, box[3] + overlap)
+
+def start_render_pool(workers):
+    '''
+    Starts the pool of PyMOL worker processes used by ray_tiled() and make_animation().
+    Has to be called before PyMOL is launched in this process so the workers are not forked from a running PyMOL.
+    '''
+    global render_pool
+    print "Starting "+str(workers)+" PyMOL render workers.."
+    render_pool = multiprocessing.Pool(workers, initializer=pymol_worker_init)
+    return render_pool
+
+# the session loaded in a tile worker, so it is only loaded once per render
+tile_session = None
+
+def render_tile(job):
+    '''
+    Ray traces one tile in a worker process and returns it as a uint8 RGBA array.
+    The scene comes from the session file saved by ray_tiled(), it is only loaded the first time a worker sees it.
+    '''
+    global tile_session
+    session_name, session_id, view, width, height, timeout = job
+    if tile_session != session_id:
+        pymol.cmd.load(session_name)
+        tile_session = session_id
+    pymol.cmd.set_view(view)
+
+    tile_name = ray_temp_name()
+    try:
+        pymol.cmd.png(tile_name, width=width, height=height, ray=1)
+        pymol.cmd.sync(timeout)
+        wait4ray(tile_name, timeout)
+        tile = plt.imread(tile_name)
+    finally:
+        if os.path.exists(tile_name):
+            os.remove(tile_name)
+    return (tile * 255 + 0.5).astype(np.uint8)
+
+def ray_tiled(width, height, timeout, file_name=None):
+    '''
+    Ray traces the current scene as a width x height RGBA image by splitting it into tiles which are rendered in parallel by the render_pool.
+    Every tile uses the same view and orthoscopic projection as the whole image, only shifted and narrowed by tile_view().
+    The tiles are cropped and copied into place. They do not overlap in the output so the transparency of every pixel is kept as rendered.
+    Returns a float32 array like plt.imread, or with file_name the tiles are copied as they are into a uint8 memmap of that file,
+    which is returned instead so the whole image is never held in memory, see structure_memmap().
+    '''
+    handle, session_name = tempfile.mkstemp(suffix=".pse")
+    os.close(handle)
+    pymol.cmd.save(session_name)
+    session_id = uuid.uuid4().hex
+    view = pymol.cmd.get_view()
+
+    boxes = list(tile_boxes(width, height, tile_size, tile_overlap))
+    jobs = [(session_name, session_id, tile_view(view, width, height, padded), padded[2] - padded[0], padded[3] - padded[1], timeout) for box, padded in boxes]
+    print "Ray tracing "+str(len(jobs))+" tiles of "+str(tile_size)+" pixels.."
+
+    if file_name == None:
+        image = np.zeros((height, width, 4), np.float32)
+    else:
+        image = np.lib.format.open_memmap(file_name, mode="w+", dtype=np.uint8, shape=(height, width, 4))
+    try:
+        for (box, padded), tile in itertools.izip(boxes, render_pool.imap(render_tile, jobs)):
+            left, top, right, bottom = box
+            tile = tile[tile_overlap:tile_overlap + bottom - top, tile_overlap:tile_overlap + right - left]
+            image[top:bottom, left:right] = tile if file_name != None else tile / 255.0
+    finally:
+        os.remove(session_name)
+    return image
+
+def compare_renders(first, second, tolerance=2):
+    '''
+    Compares two RGBA renders, as floats or bytes. Returns the largest difference of any channel (out of 255)
+    and the fraction of pixels which differ by more than tolerance.
+    '''
+    def levels(image):
+        # a --strips render is already in bytes
+        if image.dtype == np.uint8:
+            return image.astype(np.int16)
+        return np.round(image * 255).astype(np.int16)
+    difference = np.abs(levels(first) - levels(second)).max(axis=2)
+    return int(difference.max()), float((difference > tolerance).mean())
+
+def check_tiled_render(image, timeout):
+    '''
+    Does the single-shot render of the current scene and prints how far the tiled render is from it.
+    '''
+    single_name = ray_temp_name()
+    pymol.cmd.png(single_name, ray=1, width=image_width, height=image_height, dpi=image_dpi)
+    pymol.cmd.sync(timeout)
+    wait4ray(single_name, timeout)
+    single = plt.imread(single_name)
+    os.remove(single_name)
+    largest, fraction = compare_renders(image, single)
+    print "Tiled render vs single-shot render: largest difference "+str(largest)+"/255, "+'%.3f' % (100*fraction)+"% of pixels differ by more than 2/255"
+    return largest, fraction
 
 #### Some colour functions #####
     
@@ -204,21 +788,27 @@ def show_palette(palette):
 
     return None
 
-def load_palette(colourSet, palette):
+def get_palette(palette):
     '''
-    When supplied with the --palette flag and a palettable palette has been supplied, the user is asked to give a colour for each object of the image.
-    This is pretty clunky but easy way of exploring colour arrangements that you like.
-    Requires raw unput from command line.
-    Outputs a dictionary of the selected colours in rgb 0.0 to 1.0
+    Imports a palettable palette from its name, i.e. palettable.wesanderson.Darjeeling3_5
     '''
-
     import importlib
 
     mod = palette.split(".")[-1]
     package = ".".join(palette.split(".")[0:-1])
 
     palette_package = importlib.import_module(package)
-    colour_object = getattr(palette_package, mod)
+    return getattr(palette_package, mod)
+
+def load_palette(colourSet, palette):
+    '''
+    When supplied with the --palette flag and a palettable palette has been supplied, the user is asked to give a colour for each object of the image.
+    This is pretty clunky but easy way of exploring colour arrangements that you like.
+    Requires raw unput from command line.
+    Outputs a dictionary of the selected colours in rgb 0.0 to 1.0
+    '''
+
+    colour_object = get_palette(palette)
 
     show_palette(colour_object)
 
@@ -243,57 +833,632 @@ def load_palette(colourSet, palette):
 
 ################################### Figure generator ####################################
 
-def structure_layer(structure, do_ray):
+def chain_terms(spec):
+    '''
+    Splits a role of the chains dict into its terms. Each term is (kind, pattern, rank), kind being "chain", "entity" or "type".
+    The rank decides which role a chain goes to when it matches more than one: plain chain ids first, then entities,
+    then chain wildcards (the more literal characters the better) and entity types last.
+    '''
+    if isinstance(spec, basestring):
+        spec = spec.split(",")
+    terms = []
+    for term in spec:
+        term = term.strip()
+        kind = "chain"
+        if ":" in term and term.split(":", 1)[0] in ("entity", "type"):
+            kind, term = term.split(":", 1)
+        wildcard = any(character in term for character in "*?[")
+        if kind == "chain":
+            rank = (2, -len(term.strip("*?"))) if wildcard else (0, 0)
+        elif kind == "entity":
+            rank = (1, 0)
+        else:
+            rank = (3, -len(term.strip("*?")))
+        terms.append((kind, term, rank))
+    return terms
+
+def match_chains(chains, structure_chains, entities=None):
+    '''
+    Partitions the chains of a structure between the roles of a chains dict in one pass.
+    structure_chains are the chain ids in the structure and entities the "entities" from parse_pdb_info(), needed for entity: and type: terms.
+    Every chain goes to the role with the best ranked term that matches it, see chain_terms(), and chains that match no role are left out.
+    Returns a dict of role to the list of its chain ids.
+    '''
+    terms = dict((role, chain_terms(spec)) for role, spec in chains.items())
+    chain_entities = {}
+    for entity in entities or []:
+        for chain in entity["chains"]:
+            chain_entities[chain] = entity
+    if entities == None and any(kind != "chain" for role in terms for kind, term, rank in terms[role]):
+        raise ValueError("entity: and type: chains need the entities from the mmcif header")
+
+    groups = dict((role, []) for role in chains)
+    for chain in structure_chains:
+        entity = chain_entities.get(chain)
+        matches = {}
+        for role in terms:
+            for kind, term, rank in terms[role]:
+                if kind == "chain":
+                    matched = fnmatch.fnmatchcase(chain, term)
+                elif kind == "entity":
+                    matched = entity != None and entity["id"] == term
+                else:
+                    matched = entity != None and fnmatch.fnmatchcase(entity["type"], term)
+                if matched:
+                    matches[role] = min(rank, matches.get(role, rank))
+        if not matches:
+            continue
+        best = min(matches.values())
+        roles = sorted(role for role in matches if matches[role] == best)
+        if len(roles) > 1:
+            raise ValueError("Chain "+chain+" matches "+" and ".join(roles)+" equally well")
+        groups[roles[0]].append(chain)
+
+    empty = sorted(role for role in groups if not groups[role])
+    if empty:
+        raise ValueError("No chains in the structure match "+", ".join(empty)+". The structure has chains "+", ".join(structure_chains))
+    return groups
+
+def setup_chains(structure, chains, colours, entities=None):
+    '''
+    Sorts the chains of the structure into objects.
+    chains is a dict of object role to chains, e.g. chains_dict at the top of the script, which match_chains() resolves against the structure in one pass.
+    Each role is selected as one selection, coloured with the matching colour in colours and extracted as an object called role_obj.
+    Extracting moves the atoms rather than copying them, so the set up stays quick and small for entries with hundreds of chains.
+    '''
+    groups = match_chains(chains, pymol.cmd.get_chains(structure), entities)
+    for role in sorted(groups):
+        pymol.cmd.select(role, selection=structure+" and chain "+"+".join(groups[role]))
+
+        if colours[role][0] == "#":
+            set_new_colour(role+"_colour", hex_to_fraction(colours[role]))
+        else:
+            set_new_colour(role+"_colour", colours[role])
+        pymol.cmd.color(role+"_colour", role)
+        pymol.cmd.extract(role+"_obj", role)
+        # the role selection now points at the atoms in their new object
+        pymol.cmd.select(role, role+"_obj")
+
+    # the HLA helices are only picked out when the entry is a pMHC
+    if "HLAA" in chains and "HLAB" in chains:
+        pymol.cmd.select("HLA_a1a2", selection="HLAA_obj and resi 46-78 or HLAB_obj and resi 54-91")
+        pymol.cmd.create("HLA_a1a2_obj", selection="HLA_a1a2")
+    return groups
+
+def show_structure(roles, transparency):
+    '''
+    Shows each chain object made by setup_chains() as a surface plus anything extra in representationSet, with its transparency.
+    '''
+    # Building our first figure
+    pymol.cmd.hide("everything", "all")
+
+    # show each chain object as a surface and give it some transparency
+    for role in roles:
+        for representation in representationSet.get(role, ["surface"]):
+            pymol.cmd.show(representation, role+"_obj")
+        pymol.cmd.set("transparency", transparency.get(role, 0.0), role+"_obj")
+
+    # show HLA helices
+    if "HLA_a1a2" in pymol.cmd.get_names("selections"):
+        pymol.cmd.show("cartoon", "HLA_a1a2")
+    return None
+
+def structure_layer(structure, do_ray, roles=None, view=None, transparency=None, saveas="complex_image.png", prepared=False):
     '''
     This is where all the PyMOL work is done.
     An image on a transparent canvas is outputted as png.
 
 
     Uses PyMOL to visualise the structure provided.
+    roles are the chain objects made by setup_chains(), each is shown as a surface plus anything extra in representationSet.
+    view and transparency default to complex_view and transparencySet at the top of the script.
     make do_ray = 1 to ray trace the image (time consuming)
     make do_ray = 0 to skip retracing i.e. debugging or testing other parts of the code.
+    prepared=True skips show_structure() when the representations are already set up, i.e. after a warm start.
+    Returns the ray traced image as an RGBA array, or None if do_ray = 0.
     '''
-    # Building our first figure
-    pymol.cmd.hide("everything", "all")
-
-    # show HLA
-    pymol.cmd.show("surface", "HLAA_obj")
-    pymol.cmd.show("surface", "HLAB_obj")
+    if roles == None:
+        roles = chains_dict.keys()
+    if view == None:
+        view = complex_view
+    if transparency == None:
+        transparency = transparencySet
 
-    # give these surfaces some transparency
-    pymol.cmd.set("transparency", 0.1, "HLAA_obj")
-    pymol.cmd.set("transparency", 0.1, "HLAB_obj")
-
-    # show HLA helices
-    pymol.cmd.show("cartoon", "HLA_a1a2")
-
-    # show peptide
-    pymol.cmd.show("surface", "peptide_obj")
-    pymol.cmd.set("transparency", 0.1, "peptide_obj")
-
-    # show peptide as sticks
-    pymol.cmd.show("sticks", "peptide_obj")
-  
-    # show TCR
-    pymol.cmd.show("surface", "TCRA_obj")
-    pymol.cmd.set("transparency", 0.0, "TCRA_obj")
-    
-    pymol.cmd.show("surface", "TCRB_obj")
-    pymol.cmd.set("transparency", 0.0, "TCRB_obj")
+    if not prepared:
+        show_structure(roles, transparency)
 
     # set the view, save the scene and render the image (if do_ray=True)
-    complex_view = ("\
-    -0.194591478,    0.968047142,   -0.158180326,\
-    -0.116970502,   -0.183013782,   -0.976128042,\
-    -0.973888516,   -0.171443373,    0.148845106,\
-     0.000085423,    0.000001311, -432.039001465,\
-   -35.504920959,   24.705741882,  -28.177782059,\
-   377.880249023,  486.194641113,   20.000000000")
-    
-    pymol.cmd.set_view(complex_view)
+    pymol.cmd.set_view(view)
     pymol.cmd.scene("complex_image", "store")
-    rayTime("complex_image.png", do_ray)
+    with profile_stage("structure.ray"):
+        # with --strips the png is memory mapped later rather than read in as floats
+        image = rayTime(saveas, do_ray, as_array=not strip_output)
+
+    return image
+
+############################# Mask layers ###############################
+
+# settings which make PyMOL draw every object in its flat colour, for the chain id mask
+mask_settings = [   ("ambient",         1.0),
+                    ("direct",          0.0),
+                    ("reflect",         0.0),
+                    ("specular",        0.0),
+                    ("ray_trace_mode",  0),
+                    ("ray_trace_fog",   0),
+                    ("depth_cue",       0),
+                    ("antialias",       0)
+                ]
+
+# the shading layer is rendered with every object this grey, so lighting up to twice as bright is not clipped
+mask_grey = 0.5
+
+def mask_id_colours(count):
+    '''
+    Returns count flat colours which are as far apart as possible, used to tell the chain objects apart in the id mask.
+    '''
+    levels = [0.0, 1.0, 0.5]
+    candidates = [c for c in itertools.product(levels, repeat=3) if c != (0.0, 0.0, 0.0)]
+    if count > len(candidates):
+        raise ValueError("The id mask can only tell "+str(len(candidates))+" chain objects apart, not "+str(count))
+    return candidates[:count]
+
+def render_masks(roles, saveas=None, timeout=None):
+    '''
+    Ray traces the current scene twice to make the layers needed by recolour_layer():
+    an id mask, where every object is drawn in a flat id colour with no lighting, outlines or antialiasing,
+    and a shading layer, where every object is drawn in mask_grey with the normal settings.
+    The PyMOL settings, colours and transparency are put back afterwards.
+    Returns a dict of "roles", "ids" (index into roles, 255 for background), "shade" (lighting, 1.0 is the plain colour) and "alpha".
+    If saveas is given the masks are also saved there as a compressed .npz file.
+    '''
+    objects = [role+"_obj or "+role for role in roles]
+    saved = [(name, pymol.cmd.get(name)) for name, value in mask_settings]
+    saved_transparency = [pymol.cmd.get("transparency", role+"_obj") for role in roles]
+
+    # id mask
+    for name, value in mask_settings:
+        pymol.cmd.set(name, value)
+    id_colours = mask_id_colours(len(roles))
+    for i, role in enumerate(roles):
+        set_new_colour(role+"_mask", list(id_colours[i]))
+        pymol.cmd.color(role+"_mask", objects[i])
+        pymol.cmd.set("transparency", 0.0, role+"_obj")
+    id_image = rayTime(None, 1, as_array=True, timeout=timeout)
+    for name, value in saved:
+        pymol.cmd.set(name, value)
+    for i, role in enumerate(roles):
+        pymol.cmd.set("transparency", saved_transparency[i], role+"_obj")
+
+    # shading layer
+    set_new_colour("mask_grey", [mask_grey]*3)
+    pymol.cmd.color("mask_grey", " or ".join(objects))
+    shade_image = rayTime(None, 1, as_array=True, timeout=timeout)
+    for i, role in enumerate(roles):
+        pymol.cmd.color(role+"_colour", objects[i])
+
+    # each pixel belongs to the nearest id colour
+    ids = np.zeros(id_image.shape[:2], np.uint8)
+    nearest = np.empty(id_image.shape[:2], np.float32)
+    nearest.fill(np.inf)
+    for i, colour in enumerate(id_colours):
+        distance = ((id_image[:, :, :3] - colour)**2).sum(axis=2)
+        closer = distance < nearest
+        ids[closer] = i
+        nearest[closer] = distance[closer]
+    ids[id_image[:, :, 3] == 0] = 255
+
+    masks = {   "roles" :   np.array(roles),
+                "ids"   :   ids,
+                "shade" :   (shade_image[:, :, :3].mean(axis=2) / mask_grey).astype(np.float16),
+                "alpha" :   shade_image[:, :, 3].astype(np.float16)
+            }
+    if saveas != None:
+        np.savez_compressed(saveas, **masks)
+    return masks
+
+def load_masks(file_name):
+    '''
+    Loads the masks saved by render_masks().
+    '''
+    loaded = np.load(file_name)
+    return dict((name, loaded[name]) for name in ["roles", "ids", "shade", "alpha"])
+
+def recolour_layer(masks, colours, step=1):
+    '''
+    Colours the structure layer from the masks made by render_masks() without ray tracing.
+    Each pixel is the colour of its chain object times its shading, so it takes milliseconds rather than a new render.
+    Transparent surfaces are coloured as though the object behind them was the same colour, which is close enough for choosing a palette.
+    step > 1 makes a smaller preview by only using every step-th pixel.
+    Returns a float32 RGBA array like plt.imread.
+    '''
+    ids = masks["ids"][::step, ::step]
+    lookup = np.zeros((256, 3), np.float32)
+    for i, role in enumerate(masks["roles"]):
+        lookup[i] = matplotlib.colors.to_rgb(colours[str(role)])
+
+    layer = np.empty(ids.shape + (4,), np.float32)
+    layer[:, :, :3] = lookup[ids] * masks["shade"][::step, ::step, np.newaxis]
+    layer[:, :, 3] = masks["alpha"][::step, ::step]
+    np.clip(layer, 0.0, 1.0, out=layer)
+    return layer
+
+def explore_palettes(masks, palette, outdir, limit, step=4):
+    '''
+    Recolours the masks with up to limit combinations of the colours of a palettable palette and saves a preview of each to outdir.
+    The colours used for every preview are written to outdir/palettes.json so a favourite can be copied into colourSet.
+    '''
+    colour_object = get_palette(palette)
+    roles = [str(role) for role in masks["roles"]]
+    if colour_object.number >= len(roles):
+        combinations = itertools.permutations(colour_object.hex_colors, len(roles))
+    else:
+        combinations = itertools.product(colour_object.hex_colors, repeat=len(roles))
+
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    start = time.time()
+    index = {}
+    for i, combination in enumerate(itertools.islice(combinations, limit)):
+        colours = dict(zip(roles, combination))
+        preview_name = "palette_%04d.png" % i
+        mpimg.imsave(os.path.join(outdir, preview_name), recolour_layer(masks, colours, step))
+        index[preview_name] = colours
+
+    with open(os.path.join(outdir, "palettes.json"), "w") as handle:
+        json.dump(index, handle, indent=2, sort_keys=True)
+    print "Saved "+str(len(index))+" palette previews to "+outdir+" in "+'%.1f' % (time.time() - start)+" seconds"
+    return index
+
+############################# Structure store ###########################
+
+def open_structure(file_name):
+    '''
+    Opens a structure file for reading, gzip compressed files are decompressed on the fly.
+    '''
+    if file_name.endswith(".gz"):
+        return gzip.open(file_name, "rb")
+    return open(file_name, "rb")
+
+def store_read_index(store_dir):
+    '''
+    The store index is a json dict of entry id to file name (relative to the store), sha256 checksum and the parsed header.
+    '''
+    index_name = os.path.join(store_dir, "index.json")
+    if not os.path.exists(index_name):
+        return {}
+    with open(index_name) as handle:
+        return json.load(handle)
+
+def store_add(store_dir, pdb_id, file_name):
+    '''
+    Copies an mmCIF file into the store (gzip compressed if structure_store_gzip), parses its header and adds it to the index.
+    The index is locked while it is updated so that several batch workers can share one store.
+    The index keeps the path of the file relative to the store. Returns the entry as store_entry() does, with the path to open.
+    '''
+    pdb_id = pdb_id.lower()
+    make_dirs(store_dir)
+
+    stored_name = pdb_id+".cif"
+    if structure_store_gzip or file_name.endswith(".gz"):
+        stored_name += ".gz"
+
+    def copy(temp_name):
+        if stored_name.endswith(".gz") and not file_name.endswith(".gz"):
+            with open(file_name, "rb") as source:
+                target = gzip.open(temp_name, "wb")
+                shutil.copyfileobj(source, target)
+                target.close()
+        else:
+            shutil.copyfile(file_name, temp_name)
+    write_atomic(os.path.join(store_dir, stored_name), copy)
+
+    entry = {   "path"      :   stored_name,
+                "sha256"    :   file_checksum(os.path.join(store_dir, stored_name)),
+                "header"    :   parse_pdb_info(os.path.join(store_dir, stored_name))
+            }
+
+    with open(os.path.join(store_dir, "index.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        index = store_read_index(store_dir)
+        index[pdb_id] = entry
+        def dump(temp_name):
+            with open(temp_name, "w") as index_file:
+                json.dump(index, index_file, indent=2, sort_keys=True)
+        write_atomic(os.path.join(store_dir, "index.json"), dump)
+
+    return store_entry(store_dir, entry)
+
+def store_entry(store_dir, entry):
+    '''
+    A copy of an index entry with its path (relative to the store in the index) joined onto store_dir, ready to open.
+    This is the only place the store directory is added to the path.
+    '''
+    entry = dict(entry)
+    entry["path"] = os.path.join(store_dir, entry["path"])
+    return entry
+
+def store_fetch(store_dir, pdb_id):
+    '''
+    Downloads the gzip compressed mmCIF file of an entry from RCSB and adds it to the store.
+    '''
+    print "Downloading "+pdb_id+" from RCSB into "+store_dir+".."
+    url = structure_url % pdb_id.upper()
+    handle, temp_name = tempfile.mkstemp(suffix=".cif.gz")
+    try:
+        with os.fdopen(handle, "wb") as target:
+            shutil.copyfileobj(urllib2.urlopen(url, timeout=60), target)
+        return store_add(store_dir, pdb_id, temp_name)
+    finally:
+        os.remove(temp_name)
+
+def store_get(store_dir, pdb_id, offline=False):
+    '''
+    Returns the index entry of pdb_id from the store with the full path of the stored file.
+    If the entry is missing it is downloaded, unless offline in which case an IOError is raised.
+    '''
+    pdb_id = pdb_id.lower()
+    entry = store_read_index(store_dir).get(pdb_id)
+    if entry != None:
+        entry = store_entry(store_dir, entry)
+        if os.path.exists(entry["path"]):
+            return entry
+    if offline:
+        raise IOError(pdb_id+" is not in the structure store "+store_dir+" and --offline was given. Add it with --store_add.")
+    return store_fetch(store_dir, pdb_id)
+
+############################# Render cache ##############################
+
+def file_checksum(file_name):
+    '''
+    sha256 of a file, read in 1 MB blocks so large entries are not held in memory.
+    '''
+    checksum = hashlib.sha256()
+    with open(file_name, "rb") as handle:
+        for block in iter(lambda: handle.read(1 << 20), b""):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+def make_dirs(directory):
+    '''
+    Makes directory and any parents, unless it is there already. Another batch worker making it at the same moment is fine.
+    '''
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # another worker got there first
+            if not os.path.isdir(directory):
+                raise
+    return None
+
+def write_atomic(file_name, write, suffix=".tmp"):
+    '''
+    Writes file_name by calling write() with the name of a temporary file in the same directory, which is then renamed into place
+    so other batch workers never see half a file. suffix is for writers which go by the extension, i.e. PyMOL sessions.
+    '''
+    handle, temp_name = tempfile.mkstemp(suffix=suffix, dir=os.path.dirname(os.path.abspath(file_name)))
+    os.close(handle)
+    try:
+        write(temp_name)
+        os.rename(temp_name, file_name)
+    finally:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+    return None
+
+def view_to_list(view):
+    '''
+    PyMOL views can be given as a string or a list of 18 floats. Returns the list so views can be compared and hashed.
+    '''
+    if isinstance(view, basestring):
+        return [float(v) for v in view.split(",")]
+    return [float(v) for v in view]
+
+def scene_inputs(structure_checksum, chains, colours, transparency, detail):
+    '''
+    Everything that goes into building the PyMOL scene before the view is set:
+    the structure file (by its checksum), the chain objects and their colours, transparency and representations,
+    the PyMOL settings from initialisePymol(), the detail_inputs() the level of detail is chosen from and the PyMOL version.
+    The canvas colours (top and bottom) are left out as they are not part of the render.
+    '''
+    return {    "structure"         :   structure_checksum,
+                "chains"            :   chains,
+                "colours"           :   dict((role, colours[role]) for role in chains),
+                "transparency"      :   dict((role, transparency.get(role, 0.0)) for role in chains),
+                "representations"   :   dict((role, representationSet.get(role, ["surface"])) for role in chains),
+                "settings"          :   [[name, str(value)] for name, value in pymol_settings],
+                "detail"            :   detail,
+                "pymol"             :   pymol.cmd.get_version()[0]
+           }
+
+def view_scale(view, height):
+    '''
+    Angstroms per pixel at the origin of an orthoscopic view rendered height pixels high.
+    '''
+    view = view_to_list(view)
+    return 2 * abs(view[11]) * math.tan(math.radians(abs(view[17])) / 2) / height
+
+def detail_inputs(view, width, height):
+    '''
+    Everything the level of detail is chosen from apart from the atom count, which is fixed by the structure and chains.
+    The scale is rounded so views which only differ a little still share a warm start session.
+    '''
+    return {    "budget"    :   render_budget,
+                "pixels"    :   detail_pixels,
+                "level"     :   detail_level,
+                "levels"    :   detail_levels,
+                "scale"     :   "%.3g" % view_scale(view, height),
+                "megapixels":   "%.3g" % (width * height / 1e6)
+           }
+
+def detail_policy(atoms, view, width, height):
+    '''
+    Picks the level of detail for rendering atoms atoms at width x height pixels with view, see detail_levels.
+    With detail_level "auto" it starts at the coarsest level which is still fine enough at this pixel size, but never finer than "default",
+    and goes coarser until the estimated render time is within render_budget. Otherwise detail_level picks a level by name.
+    Returns a report of the choice, with the PyMOL settings to apply.
+    '''
+    scale = view_scale(view, height)
+    megapixels = width * height / 1e6
+
+    def estimate(level):
+        return atoms / 1000.0 * level["surface_seconds"] + megapixels * level["ray_seconds"] * math.log10(max(atoms, 10))
 
+    names = [level["name"] for level in detail_levels]
+    if detail_level != "auto":
+        chosen = detail_levels[names.index(detail_level)]
+        reason = "PyMOL's own settings" if detail_level == "default" else "requested"
+    else:
+        faithful = [i for i, level in enumerate(detail_levels) if level["feature"] <= scale * detail_pixels]
+        # the policy only ever coarsens, "high" has to be asked for
+        start = max(faithful[-1] if faithful else 0, names.index("default"))
+        chosen = detail_levels[-1]
+        reason = "coarsest level, over budget"
+        for level in detail_levels[start:]:
+            if estimate(level) <= render_budget:
+                chosen = level
+                reason = "finest level visible at this scale" if level == detail_levels[start] else "coarsened to fit the budget"
+                break
+
+    return {    "level"             :   chosen["name"],
+                "reason"            :   reason,
+                "atoms"             :   atoms,
+                "pixels"            :   [width, height],
+                "angstroms_per_pixel":  scale,
+                "estimate_seconds"  :   estimate(chosen),
+                "budget_seconds"    :   render_budget,
+                "settings"          :   chosen["settings"]
+           }
+
+def apply_detail(policy):
+    '''
+    Applies the PyMOL settings of a detail_policy() and prints the choice. Has to be done before the surfaces are shown.
+    '''
+    for name, value in policy["settings"]:
+        pymol.cmd.set(name, value)
+    print_detail(policy)
+    return None
+
+def print_detail(policy):
+    '''
+    Prints which level of detail was chosen and why.
+    '''
+    print "Level of detail: "+policy["level"]+" ("+policy["reason"]+") for "+str(policy["atoms"])+" atoms at "+'%.3f' % policy["angstroms_per_pixel"]+" A per pixel, estimated "+'%.0f' % policy["estimate_seconds"]+" of "+str(policy["budget_seconds"])+" seconds"
+    print "  "+", ".join(name+"="+str(value) for name, value in policy["settings"])
+    return None
+
+def render_cache_key(structure_checksum, chains, colours, view, transparency):
+    '''
+    Hashes everything that changes the ray traced structure layer: the scene_inputs() plus the view and the image size.
+    '''
+    inputs = scene_inputs(structure_checksum, chains, colours, transparency,
+                          detail_inputs(view, length_to_pixels(image_width, image_dpi), length_to_pixels(image_height, image_dpi)))
+    inputs["view"] = ["%.6f" % v for v in view_to_list(view)]
+    inputs["size"] = [image_width, image_height, image_dpi]
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+def cache_lookup(key, cache_dir):
+    '''
+    Returns the file name of the cached render for key, or None if there is not one.
+    A hit touches the file so that it counts as recently used for eviction.
+    '''
+    cached = os.path.join(cache_dir, key+".png")
+    if not png_complete(cached):
+        return None
+    os.utime(cached, None)
+    return cached
+
+def cache_store(key, image_name, cache_dir, max_mb):
+    '''
+    Copies a finished render into the cache and evicts the least recently used files until the cache is under max_mb, see cache_evict().
+    The copy is renamed into place so other batch workers never see half a file.
+    '''
+    make_dirs(cache_dir)
+    write_atomic(os.path.join(cache_dir, key+".png"), lambda temp_name: shutil.copyfile(image_name, temp_name))
+    cache_evict(cache_dir, max_mb)
+    return None
+
+# kinds of file kept in the render cache: renders, warm start sessions (with their inputs in a .json next to them) and plaque text layers
+cache_suffixes = (".png", ".pse", ".npz")
+
+def cache_evict(cache_dir, max_mb):
+    '''
+    Removes the least recently used files of the whole render cache, including the sessions and plaques directories in it,
+    until all of them together are under max_mb. A session goes together with its inputs .json.
+    '''
+    entries = []
+    for directory, subdirectories, names in os.walk(cache_dir):
+        for name in names:
+            if not name.endswith(cache_suffixes):
+                continue
+            files = [os.path.join(directory, name)]
+            if name.endswith(".pse"):
+                files.append(files[0][:-len(".pse")]+".json")
+            try:
+                stat = os.stat(files[0])
+                size = sum(os.path.getsize(file_name) for file_name in files if os.path.exists(file_name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, size, files))
+    entries.sort()
+
+    total = sum(size for mtime, size, files in entries)
+    while entries and total > max_mb*1024*1024:
+        mtime, size, files = entries.pop(0)
+        for file_name in files:
+            try:
+                os.remove(file_name)
+            except OSError:
+                pass
+        total -= size
+    return None
+
+def restore_scene(inputs, roles, cache_dir):
+    '''
+    Warm start: loads the cached session saved by store_scene() for these scene_inputs(), with its objects, colours and precomputed surfaces.
+    The inputs stored next to the session are checked against the current ones and every chain object has to be there.
+    Returns True if the scene was restored, otherwise PyMOL is reinitialised and False is returned so the scene is built as normal.
+    '''
+    key = hashlib.sha256(json.dumps(inputs, sort_keys=True)).hexdigest()
+    session_name = os.path.join(cache_dir, key+".pse")
+    inputs_name = os.path.join(cache_dir, key+".json")
+    if not (os.path.exists(session_name) and os.path.exists(inputs_name)):
+        return False
+    with open(inputs_name) as handle:
+        stored = json.load(handle)
+    # round trip the current inputs through json so lists and strings compare like for like
+    if stored != json.loads(json.dumps(inputs)):
+        print "Cached session "+session_name+" does not match the current structure and settings, rebuilding it.."
+        return False
+
+    print "Warm start from cached session "+session_name
+    pymol.cmd.load(session_name)
+    objects = pymol.cmd.get_names("objects")
+    missing = [role+"_obj" for role in roles if role+"_obj" not in objects]
+    if missing:
+        print "Cached session is missing "+", ".join(missing)+", rebuilding it.."
+        initialisePymol()
+        return False
+    os.utime(session_name, None)
+    return True
+
+def store_scene(inputs, cache_dir, max_mb):
+    '''
+    Saves the current scene for restore_scene(). PyMOL's cache is enabled and filled first,
+    so the molecular surfaces are computed now and saved in the session rather than recomputed after every warm start.
+    '''
+    key = hashlib.sha256(json.dumps(inputs, sort_keys=True)).hexdigest()
+    make_dirs(cache_dir)
+
+    pymol.cmd.cache("enable")
+    pymol.cmd.scene("warm_start", "store")
+    pymol.cmd.cache("optimize", "warm_start")
+
+    with open(os.path.join(cache_dir, key+".json"), "w") as inputs_file:
+        json.dump(inputs, inputs_file, indent=2, sort_keys=True)
+    write_atomic(os.path.join(cache_dir, key+".pse"), pymol.cmd.save, suffix=".pse")
+    # the sessions directory is part of the render cache and shares its size limit
+    cache_evict(os.path.dirname(os.path.abspath(cache_dir)), max_mb)
     return None
 
 #########################################################################################
@@ -356,17 +1521,170 @@ def title_on_lines(title, max_on_line):
 
     return output
 
-def parse_pdb_info(pdb_id):
+def mmcif_splitline(line):
+    '''
+    Splits one line of an mmCIF file into tokens, the same way as Biopython's MMCIF2Dict.
+    Quoted tokens may contain whitespace and only close on a quote followed by whitespace. An unquoted # starts a comment.
+    '''
+    in_token = False
+    quote_open_char = None
+    start_i = 0
+    for i, c in enumerate(line):
+        if c in " \t":
+            if in_token and not quote_open_char:
+                in_token = False
+                yield line[start_i:i]
+        elif c in "'\"":
+            if not quote_open_char and not in_token:
+                quote_open_char = c
+                in_token = True
+                start_i = i + 1
+            elif c == quote_open_char and (i + 1 == len(line) or line[i + 1] in " \t"):
+                quote_open_char = None
+                in_token = False
+                yield line[start_i:i]
+        elif c == "#" and not in_token:
+            return
+        elif not in_token:
+            in_token = True
+            start_i = i
+    if in_token:
+        yield line[start_i:]
+    if quote_open_char:
+        raise ValueError("Line ended with quote open: " + line)
+
+def mmcif_tokens(handle, state):
+    '''
+    Yields the tokens of an mmCIF file. Multi-line values between semicolons are yielded as one token.
+    While state["skip"] is set, whole lines are passed over without being split until the next line that starts a key, loop_ or data_.
+    This is how read_mmcif_header() gets through the _atom_site loop quickly.
+    '''
+    for line in handle:
+        if state["skip"]:
+            if line.startswith(";"):
+                # skip over a multi-line value, which may contain lines starting with _
+                for line in handle:
+                    if line.startswith(";"):
+                        break
+                continue
+            stripped = line.lstrip()
+            if not (stripped.startswith("_") or stripped[:5].lower() in ("loop_", "data_")):
+                continue
+            state["skip"] = False
+        if line.startswith("#"):
+            continue
+        if line.startswith(";"):
+            token_buffer = [line[1:].rstrip()]
+            for line in handle:
+                line = line.rstrip()
+                if line.startswith(";"):
+                    yield "\n".join(token_buffer)
+                    line = line[1:]
+                    break
+                token_buffer.append(line)
+            else:
+                raise ValueError("Missing closing semicolon")
+        for token in mmcif_splitline(line.strip()):
+            yield token
+
+def read_mmcif_header(handle, categories):
+    '''
+    A streaming alternative to Biopython's MMCIF2Dict which only keeps the categories asked for, i.e. ["_citation", "_cell"].
+    Returns a dict of key to list of values, the same as MMCIF2Dict gives for those keys.
+    Loops of other categories are skipped line by line without being split into tokens,
+    and reading stops as soon as every requested category has been read, so the coordinates are usually never looked at.
+    '''
+    remaining = set(categories)
+    mmcif_dict = {}
+    # skip is read by mmcif_tokens(), skipped marks that the rest of the current loop is being passed over
+    state = {"skip" : False, "skipped" : False}
+    tokens = mmcif_tokens(handle, state)
+
+    for token in tokens:
+        mmcif_dict[token[0:5]] = token[5:]
+        break
+
+    current = None
+    loop_flag = False
+    keep = False
+    keys = []
+    i = 0
+    n = 0
+    key = None
+    for token in tokens:
+        if token.lower() == "loop_":
+            loop_flag = True
+            state["skipped"] = False
+            keys = []
+            i = 0
+            n = 0
+            continue
+        elif loop_flag:
+            # a key in the first column after the values have started ends the loop
+            if token.startswith("_") and (n == 0 or i % n == 0 or state["skipped"]):
+                if i > 0:
+                    loop_flag = False
+                    state["skipped"] = False
+                else:
+                    category = token.split(".")[0]
+                    if category != current:
+                        remaining.discard(current)
+                        if not remaining:
+                            break
+                        current = category
+                    keep = category in remaining
+                    if keep:
+                        mmcif_dict[token] = []
+                    keys.append(token)
+                    n += 1
+                    continue
+            else:
+                if keep:
+                    mmcif_dict[keys[i % n]].append(token)
+                elif not state["skipped"]:
+                    # none of this loop is wanted, pass over the rest of it a line at a time
+                    state["skip"] = True
+                    state["skipped"] = True
+                i += 1
+                continue
+        if key is None:
+            key = token
+            category = key.split(".")[0]
+            if category != current:
+                remaining.discard(current)
+                if not remaining:
+                    break
+                current = category
+        else:
+            if current in remaining:
+                mmcif_dict[key] = [token]
+            key = None
+    return mmcif_dict
+
+# the mmcif categories which parse_pdb_info() reads
+header_categories = ["_entry", "_citation", "_citation_author", "_reflns", "_symmetry", "_cell", "_entity_poly"]
+
+def parse_pdb_info(pdb_id, parser="stream"):
     '''
     Rips out some info from the mmcif header and returns a dict
     Used to form the plaque.
     This is currently only mmcif compatible and not pdb (because 6R0E is uploaded only in cif format.. no PDB)
+    The file may be gzip compressed, as it is in the structure store.
+    By default only the header categories are read with read_mmcif_header(). parser="biopython" reads the whole file with MMCIF2Dict instead.
     '''
 
     # parser = MMCIFparser()
     # structure = parser.get_structure('complex', '6r0e.cif')
-    from Bio.PDB.MMCIF2Dict import MMCIF2Dict
-    mmcif_dict = MMCIF2Dict(pdb_id)
+    with profile_stage("metadata.parse"):
+        handle = open_structure(pdb_id)
+        try:
+            if parser == "biopython":
+                from Bio.PDB.MMCIF2Dict import MMCIF2Dict
+                mmcif_dict = MMCIF2Dict(handle)
+            else:
+                mmcif_dict = read_mmcif_header(handle, header_categories)
+        finally:
+            handle.close()
 
     output = {}
 
@@ -397,19 +1715,121 @@ def parse_pdb_info(pdb_id):
     output["authorlines"] = author_on_lines(mmcif_dict["_citation_author.name"], 8)
     output["titlelines"] = title_on_lines(mmcif_dict["_citation.title"][0], 9)
 
+    # the polymer entities and their (author) chain ids, used to pick chains by entity in match_chains()
+    output["entities"] = []
+    for entity, kind, strands in zip(mmcif_dict.get("_entity_poly.entity_id", []), mmcif_dict.get("_entity_poly.type", []), mmcif_dict.get("_entity_poly.pdbx_strand_id", [])):
+        output["entities"].append({"id" : entity, "type" : kind, "chains" : [chain.strip() for chain in strands.split(",")]})
+
     return output
 
 #########################################################################################
 ################################## Canvas generator #####################################
-def canvas(image_name, info_dict):
+# advance widths of characters at a font size of 1 point, by font weight, see font_metrics()
+font_metrics_cache = {}
+# rasterised plaque text layers by cache key, see cached_text_layer()
+plaque_cache = collections.OrderedDict()
+plaque_cache_entries = 16
+# bumped whenever text_layer() draws differently, so plaque layers cached by an older version are not used
+text_layer_version = 2
+
+def font_metrics(weight, text):
     '''
-    Creates the canvas for the artwork.
+    Returns the advance width of every character in text at a font size of 1 point in the default font of the given weight.
+    Each character is only measured once, the widths are kept in font_metrics_cache.
+    '''
+    from matplotlib.font_manager import FontProperties
+    from matplotlib.textpath import TextToPath
+    widths = font_metrics_cache.setdefault((tuple(matplotlib.rcParams["font.family"]), weight), {})
+    missing = set(text) - set(widths)
+    if missing:
+        measure = TextToPath()
+        properties = FontProperties(weight=weight, size=100)
+        for character in missing:
+            widths[character] = measure.get_text_width_height_descent(character, properties, ismath=False)[0] / 100.0
+    return widths
+
+def text_widths(pieces, weight, fontsize):
+    '''
+    Widths in points of each string in pieces, from the cached font_metrics().
+    '''
+    widths = font_metrics(weight, "".join(pieces))
+    return np.array([sum(widths[character] for character in piece) for piece in pieces]) * fontsize
+
+def wrap_to_width(pieces, separator, max_width, weight="normal", fontsize=None):
+    '''
+    Wraps pieces (words, or authors) joined by separator onto lines no wider than max_width points.
+    The end of every piece along one long line is worked out at once with a cumulative sum, each line then ends at the last piece which fits.
+    A piece wider than a whole line gets a line of its own. Returns the list of lines.
+    '''
+    if fontsize == None:
+        fontsize = matplotlib.rcParams["font.size"]
+    if not pieces:
+        return []
+    gap = text_widths([separator], weight, fontsize)[0]
+    ends = np.cumsum(text_widths(pieces, weight, fontsize) + gap) - gap
+    lines = []
+    start = 0
+    offset = 0.0
+    while start < len(pieces):
+        stop = max(int(np.searchsorted(ends, offset + max_width, side="right")), start + 1)
+        lines.append(separator.join(pieces[start:stop]))
+        offset = ends[stop - 1] + gap
+        start = stop
+    return lines
+
+def plaque_lines(info_dict):
+    '''
+    The title lines and the author lines of the plaque, wrapped to plaque_width of the page with wrap_to_width().
+    The title is measured in bold as that is how it is drawn.
+    '''
+    max_width = page_size[0] * 72.0 * plaque_width
+    title_lines = wrap_to_width(info_dict["title"].split(), " ", max_width, weight="bold")
+    author_lines = wrap_to_width(list(info_dict["authors"]), ", ", max_width)
+    return title_lines, "\n".join(author_lines)
+
+def plaque_texts(info_dict):
+    '''
+    The text drawn onto the canvas: the plaque and the signature link to this source code.
+    Returns a list of (string, (x, y) in fractions of the page, annotate keyword arguments) shared by both canvas compositors.
+    '''
+    # Generate the "plaque"
+    # Forms a big string to be annotated onto the canvas
+    big_string = r'$\bf{%s}$' % str(info_dict["id"])
+    big_string += "\n" + "Resoution: "+'%.1f' % info_dict["resolution"] + r' $\AA$' + ". " +"Space group: "+info_dict["spacegroup"]+ ". "+ "Unit cell: "+info_dict["unitcell"]+"."+"\n"
+    
+    title_lines, author_lines = plaque_lines(info_dict)
+    for line in title_lines:
+        line_new = line.replace(" ", "\\ ")
+        big_string += "\n" + r'$\bf{%s}$' % line_new
+
+    big_string += "\n" + info_dict["journal"]+" "+info_dict["year"]
+    big_string += "\n\n" + author_lines
+
+    texts = []
+    # Place the plaque
+    texts.append((big_string, (0.5, 0.075), dict(ha="center", bbox=dict(facecolor='white', edgecolor='black', pad=10.0, linewidth=5.0))))
+    # Add a signature link to this source code on github
+    texts.append(("Source code: github.com/brucemaclachlan/6R0E_artwork", (0.95, 0.035), dict(ha="right", color='black', weight='bold', fontsize=9, alpha=0.2)))
+    return texts
+
+def load_image(image):
+    '''
+    Loads the png image outputted by PyMOL, unless it has been handed over in memory.
+    '''
+    if isinstance(image, basestring):
+        return plt.imread(image)
+    return image
+
+def canvas_figure(image, info_dict, colours):
+    '''
+    The original canvas compositor.
     This takes the form of a matplotlib plot with no axes and no space around the edges.
     We can then treat the plot like a canvas
+    Returns the figure, the caller has to close it.
     '''
 
     # ferameon=False required to remove the margin around the plot
-    fig = plt.figure(figsize=(11.7,16.5), dpi = 300, facecolor="w", frameon=False)
+    fig = plt.figure(figsize=page_size, dpi = page_dpi, facecolor="w", frameon=False)
 
     # puts the canvas onto a axis scale between 0 and 1 in both directions
     ax = fig.add_axes([0, 0, 1, 1])
@@ -419,43 +1839,1793 @@ def canvas(image_name, info_dict):
     plt.autoscale(tight=True)
 
     # This creates a split background. The bottom is meant to represent the cell surface.
-    ax.axhspan(0, 0.33,facecolor=colourSet['bottom'])
-    ax.axhspan(0.33, 1.0 ,facecolor=colourSet['top'])
-
-    # load the png image outputted by PyMOL
-    im = plt.imread(image_name)
+    ax.axhspan(0, band_split,facecolor=colours['bottom'])
+    ax.axhspan(band_split, 1.0 ,facecolor=colours['top'])
 
     # show the image on the canvas      
-    fig.figimage(im, 600, 1000, zorder=10)
+    fig.figimage(load_image(image), structure_offset[0], structure_offset[1], zorder=10)
 
-    # Generate the "plaque"
-    # Forms a big string to be annotated onto the canvas
-    big_string = r'$\bf{%s}$' % str(info_dict["id"])
-    big_string += "\n" + "Resoution: "+'%.1f' % info_dict["resolution"] + r' $\AA$' + ". " +"Space group: "+info_dict["spacegroup"]+ ". "+ "Unit cell: "+info_dict["unitcell"]+"."+"\n"
-    
-    for line in info_dict["titlelines"]:
-        line_new = line.replace(" ", "\\ ")
-        big_string += "\n" + r'$\bf{%s}$' % line_new
+    for text, xy, kwargs in plaque_texts(info_dict):
+        ax.annotate(text, xy=xy, xycoords='axes fraction', **kwargs)
+    return fig
 
-    big_string += "\n" + info_dict["journal"]+" "+info_dict["year"]
-    big_string += "\n\n" + info_dict["authorlines"]
+def page_pixels(dpi):
+    '''
+    Width and height of the canvas in pixels.
+    '''
+    return int(round(page_size[0]*dpi)), int(round(page_size[1]*dpi))
 
-    # Place the plaque
-    ax.annotate(big_string, xy=(0.5, 0.075), xycoords='axes fraction', ha="center", bbox=dict(facecolor='white', edgecolor='black', pad=10.0, linewidth=5.0))
+def text_layer(text, x, y, dpi, kwargs, background):
+    '''
+    Rasterises one piece of text (and its bbox) on its own, onto a layer only as big as the text.
+    x and y are the anchor of the text in page pixels from the bottom left, as annotate would place it.
+    The text is measured on a tiny figure first, as its size does not depend on the figure, and then drawn onto a figure cropped to it.
+    The crop is shifted by whole pixels so the glyphs land on the same pixels as on the full page.
+    The text is drawn over the background bands behind it, background being the top and bottom colours as 0-255 arrays,
+    so its antialiased edges are blended exactly as on the full page. Every pixel the text changed is opaque in the layer and the rest are transparent.
+    Returns the uint8 RGBA layer and the column and row of its top left corner on the page.
+    '''
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.transforms import Bbox, IdentityTransform
+
+    figure = Figure(figsize=(1, 1), dpi=dpi)
+    FigureCanvasAgg(figure)
+    renderer = figure.canvas.get_renderer()
+    # Figure.text puts its own transFigure over a transform passed to it on matplotlib 2, so it is set afterwards to place the text in pixels
+    artist = figure.text(x, y, text, **kwargs)
+    artist.set_transform(IdentityTransform())
+    # only the layout is needed here, the text is drawn once on the cropped figure
+    artist.update_bbox_position_size(renderer)
+    extents = [artist.get_window_extent(renderer)]
+    margin = 4.0
+    if artist.get_bbox_patch() != None:
+        extents.append(artist.get_bbox_patch().get_window_extent(renderer))
+        margin += artist.get_bbox_patch().get_linewidth() * dpi / 72.0
+    extent = Bbox.union(extents)
+
+    left = int(math.floor(extent.x0 - margin))
+    bottom = int(math.floor(extent.y0 - margin))
+    width = int(math.ceil(extent.x1 + margin)) - left
+    height = int(math.ceil(extent.y1 + margin)) - bottom
+
+    figure = Figure(figsize=(width/float(dpi), height/float(dpi)), dpi=dpi, frameon=False)
+    FigureCanvasAgg(figure)
+    width, height = figure.canvas.get_width_height()
+    page_height = page_pixels(dpi)[1]
+    top = page_height - bottom - height
+    behind = background_rows(background[0], background[1], page_height, top, top + height, width)
+    figure.figimage(behind, 0, 0)
+    figure.text(x - left, y - bottom, text, **kwargs).set_transform(IdentityTransform())
+    figure.canvas.draw()
+    layer = np.frombuffer(figure.canvas.buffer_rgba(), np.uint8).reshape(height, width, 4).copy()
+    layer[:, :, 3] = np.where((layer[:, :, :3] != behind).any(axis=2), 255, 0)
+
+    return layer, left, top
+
+def cached_text_layer(text, x, y, dpi, kwargs, background):
+    '''
+    text_layer() with a cache, keyed by the text, where it goes, its style, the background, the matplotlib version and text_layer_version.
+    The layers are kept in memory for the daemon and batch workers and saved in a plaques directory of the render cache,
+    so the slow mathtext layout of a plaque is only done once however many times an entry is drawn with the same background.
+    '''
+    key = hashlib.sha256(json.dumps([text_layer_version, text, "%.3f" % x, "%.3f" % y, dpi, kwargs, [list(np.around(colour)) for colour in background],
+                                     band_split, matplotlib.__version__, matplotlib.rcParams["font.family"],
+                                     matplotlib.rcParams["font.size"], matplotlib.rcParams["mathtext.fontset"]], sort_keys=True)).hexdigest()
+    if key in plaque_cache:
+        plaque_cache[key] = plaque_cache.pop(key)
+        return plaque_cache[key]
+
+    cache_dir = None if render_cache_dir == None else os.path.join(render_cache_dir, "plaques")
+    file_name = None if cache_dir == None else os.path.join(cache_dir, key+".npz")
+    if file_name != None and os.path.exists(file_name):
+        stored = np.load(file_name)
+        layer = (stored["layer"], int(stored["left"]), int(stored["top"]))
+        os.utime(file_name, None)
+    else:
+        layer = text_layer(text, x, y, dpi, kwargs, background)
+        if file_name != None:
+            make_dirs(cache_dir)
+            def save(temp_name):
+                # given a file name rather than a file, savez would add .npz to it
+                with open(temp_name, "wb") as temp_file:
+                    np.savez_compressed(temp_file, layer=layer[0], left=layer[1], top=layer[2])
+            write_atomic(file_name, save)
+            cache_evict(render_cache_dir, render_cache_size)
+
+    plaque_cache[key] = layer
+    while len(plaque_cache) > plaque_cache_entries:
+        plaque_cache.popitem(last=False)
+    return layer
+
+def canvas_layers(image, info_dict, colours, dpi=None):
+    '''
+    Everything the numpy compositor needs to draw the canvas: the page size, the background colours and the layers which are
+    alpha blended over the background in order, each as (RGBA array, left column, top row).
+    The text layers come first and the structure last, as the figimage was drawn above the axes in the original canvas.
+    With image=None only the background and text are set up, the structure is placed later with structure_overlay().
+    '''
+    if dpi == None:
+        dpi = page_dpi
+    width, height = page_pixels(dpi)
+    layers = {  "width"     :   width,
+                "height"    :   height,
+                "top"       :   np.array(matplotlib.colors.to_rgb(colours['top'])) * 255,
+                "bottom"    :   np.array(matplotlib.colors.to_rgb(colours['bottom'])) * 255,
+                "overlays"  :   []
+             }
+    for text, xy, kwargs in plaque_texts(info_dict):
+        layers["overlays"].append(cached_text_layer(text, xy[0]*width, xy[1]*height, dpi, kwargs, (layers["top"], layers["bottom"])))
+
+    if image is not None:
+        layers["overlays"].append(structure_overlay(load_image(image), height, dpi))
+    return layers
+
+def structure_overlay(structure, page_height, dpi):
+    '''
+    Places the structure layer on the page. structure_offset is in pixels at page_dpi so it is scaled for other dpis.
+    '''
+    scale = dpi / float(page_dpi)
+    left = int(round(structure_offset[0] * scale))
+    bottom = int(round(structure_offset[1] * scale))
+    return structure, left, page_height - bottom - structure.shape[0]
 
-    # Add a signature link to this source code on github
-    watermark = ax.annotate("Source code: github.com/brucemaclachlan/6R0E_artwork", xy=(0.95, 0.035), xycoords='axes fraction', ha="right", color='black', weight='bold', fontsize=9)
-    watermark.set_alpha(0.2)
+def compose_rows(layers, top, bottom, output=None):
+    '''
+    Composes rows top to bottom (counted from the top of the page) of the canvas into a uint8 RGBA array, output if one is given.
+    The background bands are filled in by background_rows(). Each layer is then alpha blended by blend_pixels() over the part of the rows
+    it covers, with the same integer sums as Agg so the page comes out as matplotlib draws it. Float layers are turned into bytes first
+    the way matplotlib does for figimage, by truncating rather than rounding.
+    '''
+    width = layers["width"]
+    if output is None:
+        output = np.empty((bottom - top, width, 4), np.uint8)
+    # each band is filled with a whole opaque row at a time, which numpy copies far quicker than a colour broadcast over every pixel
+    edge = band_edge(layers["height"])
+    row = np.empty((width, 4), np.uint8)
+    row[:, 3] = 255
+    for colour, first, last in ((layers["top"], top, min(bottom, edge)), (layers["bottom"], max(top, edge), bottom)):
+        if first < last:
+            row[:, :3] = np.around(colour)
+            output[first - top:last - top] = row
+
+    for layer, left, layer_top in layers["overlays"]:
+        first = max(top, layer_top)
+        last = min(bottom, layer_top + layer.shape[0])
+        start = max(0, left)
+        stop = min(width, left + layer.shape[1])
+        if first >= last or start >= stop:
+            continue
+        source = layer[first - layer_top:last - layer_top, start - left:stop - left]
+        # only the rows and columns the layer actually covers are blended
+        covered = source[:, :, 3] > 0
+        covered_rows = np.flatnonzero(covered.any(axis=1))
+        if not covered_rows.size:
+            continue
+        covered_columns = np.flatnonzero(covered.any(axis=0))
+        rows = slice(covered_rows[0], covered_rows[-1] + 1)
+        columns = slice(covered_columns[0], covered_columns[-1] + 1)
+        source = source[rows, columns]
+        if source.dtype != np.uint8:
+            # the same truncation as (source * 255).astype(np.uint8) without the float copy
+            scaled = np.empty(source.shape, np.uint8)
+            np.multiply(source, 255, out=scaled, casting="unsafe")
+            source = scaled
+        target = output[first - top:last - top, start:stop, :3][rows, columns]
+        blend_pixels(target, source)
+    return output
+
+def band_edge(page_height):
+    '''
+    The first row of the bottom background band, counted from the top of the page.
+    Agg snaps the edge of an axhspan to the nearest whole pixel, so the bands meet on a whole row.
+    '''
+    return int(math.floor(page_height - page_height * band_split + 0.5))
+
+def background_rows(top_colour, bottom_colour, page_height, top, bottom, width):
+    '''
+    The two background bands for rows top to bottom of the page as a uint8 RGB array of width columns.
+    '''
+    below = (np.arange(top, bottom) >= band_edge(page_height))[:, np.newaxis]
+    rows = np.empty((bottom - top, width, 3), np.uint8)
+    rows[:] = np.where(below, np.around(bottom_colour), np.around(top_colour))[:, np.newaxis, :].astype(np.uint8)
+    return rows
+
+def blend_pixels(target, source):
+    '''
+    Blends a uint8 RGBA source over the opaque uint8 RGB target in place, the way Agg's plain RGBA blender in matplotlib does:
+    fully opaque pixels are copied, fully transparent ones are left alone and only the partly transparent ones are mixed, with integer division.
+    '''
+    alpha = source[:, :, 3]
+    # a two dimensional mask per channel is several times quicker than one broadcast over the colour axis
+    opaque = alpha == 255
+    for channel in xrange(3):
+        np.copyto(target[:, :, channel], source[:, :, channel], where=opaque)
+    partial = np.nonzero((alpha != 0) & (alpha != 255))
+    if not partial[0].size:
+        return None
+    weight = alpha[partial].astype(np.int32)[:, np.newaxis]
+    colour = source[partial][:, :3].astype(np.int32)
+    behind = target[partial].astype(np.int32)
+    target[partial] = (((colour << 8) - behind * 255) * weight + behind * 65280) // (65280 + weight)
+    return None
 
-    import time
-    timestr = time.strftime("%Y%m%d-%H%M%S")
+def compose_page(layers, strip=256):
+    '''
+    Composes the whole canvas into one preallocated uint8 RGBA array, a strip of rows at a time.
+    '''
+    page = np.empty((layers["height"], layers["width"], 4), np.uint8)
+    for top in xrange(0, layers["height"], strip):
+        bottom = min(top + strip, layers["height"])
+        compose_rows(layers, top, bottom, page[top:bottom])
+    return page
+
+def draw_page(image, info_dict, colours, compositor, layers=None):
+    '''
+    Draws the whole canvas once into a uint8 RGBA array.
+    compositor is "numpy", which blends the layers straight into the array and only rasterises the text,
+    or "matplotlib", which draws the page as a matplotlib figure.
+    layers are the background and plaque from canvas_layers(None, ...) if they have already been drawn, the numpy compositor then only places the structure.
+    '''
+    if compositor == "matplotlib":
+        fig = canvas_figure(image, info_dict, colours)
+        fig.canvas.draw()
+        width, height = fig.canvas.get_width_height()
+        page = np.frombuffer(fig.canvas.buffer_rgba(), np.uint8).reshape(height, width, 4).copy()
+        # close the figure, long running batch workers would otherwise keep every canvas in memory
+        plt.close(fig)
+        return page
+    if layers == None:
+        return compose_page(canvas_layers(image, info_dict, colours))
+    layers = dict(layers)
+    layers["overlays"] = layers["overlays"] + [structure_overlay(load_image(image), layers["height"], page_dpi)]
+    return compose_page(layers)
+
+def canvas_basename(outdir):
+    '''
+    The path, without a suffix, that canvas() writes its files to in outdir: canvas_ followed by the date and time.
+    '''
+    return os.path.join(outdir, "canvas_"+time.strftime("%Y%m%d-%H%M%S"))
 
+def canvas(image, info_dict, colours=None, outdir=".", compositor=None, formats=None, layers=None, basename=None):
+    '''
+    Creates the canvas for the artwork.
+    image is either the RGBA array returned by structure_layer() or the file name of the png outputted by PyMOL.
+    colours defaults to colourSet and compositor to canvas_compositor, see draw_page().
+    The page is drawn once and then written in every format in formats (output_formats by default) by write_outputs(),
+    or with --strips composed and written a strip at a time by write_strips().
+    layers can be handed over from prepare_canvas() so only the structure is left to place, see draw_page().
+    The files are written into outdir and their file names are returned in a dict.
+    They are named basename plus the suffix of each format, canvas_basename(outdir) by default, so a caller that
+    names other files after the canvas can pick the basename first.
+    '''
+    if colours == None:
+        colours = colourSet
+    if compositor == None:
+        compositor = canvas_compositor
+    if basename == None:
+        basename = canvas_basename(outdir)
+
+    if strip_output:
+        if compositor != "numpy":
+            raise ValueError("--strips needs the numpy compositor")
+        # the memmap is only needed while the strips are written, it is as big as the structure layer so it is not left behind
+        handle, memmap_name = tempfile.mkstemp(suffix=".npy", prefix="complex_image_", dir=outdir)
+        os.close(handle)
+        try:
+            image = structure_memmap(image, memmap_name)
+            if layers == None:
+                layers = canvas_layers(image, info_dict, colours)
+            else:
+                layers = dict(layers)
+                layers["overlays"] = layers["overlays"] + [structure_overlay(image, layers["height"], page_dpi)]
+            with profile_stage("canvas.write"):
+                return write_strips(layers, basename, formats)
+        finally:
+            os.remove(memmap_name)
+
+    with profile_stage("canvas.compose"):
+        page = draw_page(image, info_dict, colours, compositor, layers)
+
+    with profile_stage("canvas.write"):
+        return write_outputs(page, basename, formats)
+
+def prepare_canvas(info_dict, colours, compositor=None):
+    '''
+    Starts drawing the background and plaque layers of the canvas in a thread, as they do not depend on the structure.
+    PyMOL lets go of the GIL while it ray traces, so this runs alongside the render.
+    Returns a function which waits for the layers and returns them, or None when the matplotlib compositor draws the page in one go.
+    '''
+    if compositor == None:
+        compositor = canvas_compositor
+    if compositor == "matplotlib":
+        return lambda: None
 
-    fig.savefig("canvas_"+timestr+".png", transparent=True, pad_inches = 0)
-    plt.savefig("canvas_"+timestr+".pdf", pad_inches = 0)
+    def layers():
+        with profile_stage("canvas.prepare"):
+            return canvas_layers(None, info_dict, colours)
+    return run_background(layers)
 
+def render_canvas(job):
+    '''
+    Draws the canvas into an array with one compositor and measures it. Run in a fresh process by compare_canvas().
+    '''
+    image, info_dict, colours, compositor = job
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    page = draw_page(image, info_dict, colours, compositor)
+    seconds = time.time() - start
+    return page, seconds, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss)/1024.0
+
+def compare_canvas(image, info_dict, colours=None):
+    '''
+    Draws the canvas with both compositors, each in a fresh process, and prints the wall time and peak memory of each
+    and how far apart the two pages are.
+    '''
+    if colours == None:
+        colours = colourSet
+    pages = {}
+    for compositor in ["matplotlib", "numpy"]:
+        pool = multiprocessing.Pool(1, maxtasksperchild=1)
+        page, seconds, peak = pool.apply(render_canvas, ((image, info_dict, colours, compositor),))
+        pool.close()
+        pool.join()
+        pages[compositor] = page
+        print compositor+" compositor: "+'%.2f' % seconds+" seconds, peak memory +"+'%.0f' % peak+" MB"
+    largest, fraction = compare_renders(pages["matplotlib"][:, :, :3]/255.0, pages["numpy"][:, :, :3]/255.0)
+    exact = compare_renders(pages["matplotlib"][:, :, :3]/255.0, pages["numpy"][:, :, :3]/255.0, tolerance=0)[1]
+    print "Largest difference "+str(largest)+"/255, "+'%.3f' % (100*fraction)+"% of pixels differ by more than 2/255, "+'%.3f' % (100*exact)+"% differ at all"
+    return largest, fraction
+
+
+#########################################################################################
+################################## Output encoders ######################################
+
+# png filter types by name
+png_filter_types = {"none" : 0, "sub" : 1, "up" : 2, "avg" : 3, "paeth" : 4}
+
+def png_filter(pixels, previous=None, method="up"):
+    '''
+    Applies a png filter to every row of a uint8 image and puts the filter type byte in front of each row.
+    method is one of png_filter_types, e.g. Up (each byte minus the byte above it), or "adaptive" which picks the filter for each row
+    whose output has the smallest sum of absolute values, as libpng does. Each filter is worked out for all the rows at once,
+    except that adaptive works through encode_chunk_rows rows at a time so only that many rows of every candidate are held at once.
+    previous is the last row of the strip above when an image is filtered a strip at a time.
+    Returns the (rows, 1 + row bytes) uint8 array which is compressed into the png IDAT stream.
+    '''
+    height = pixels.shape[0]
+    rows = pixels.reshape(height, -1)
+    filtered = np.empty((height, rows.shape[1] + 1), np.uint8)
+    if method == "adaptive" and height > encode_chunk_rows:
+        for top in xrange(0, height, encode_chunk_rows):
+            bottom = min(top + encode_chunk_rows, height)
+            filtered[top:bottom] = png_filter(pixels[top:bottom], pixels[top - 1] if top > 0 else previous, method)
+        return filtered
+    if method == "up":
+        # the usual case, done without any temporary copies
+        filtered[:, 0] = 2
+        if previous is None:
+            filtered[0, 1:] = rows[0]
+        else:
+            np.subtract(rows[0], previous.reshape(-1), out=filtered[0, 1:])
+        np.subtract(rows[1:], rows[:-1], out=filtered[1:, 1:])
+        return filtered
+
+    # the bytes of the pixel to the left (a), above (b) and above and to the left (c)
+    channels = pixels.shape[2] if pixels.ndim == 3 else 1
+    above = np.zeros_like(rows)
+    if previous is not None:
+        above[0] = previous.reshape(-1)
+    above[1:] = rows[:-1]
+    left = np.zeros_like(rows)
+    left[:, channels:] = rows[:, :-channels]
+    corner = np.zeros_like(rows)
+    corner[:, channels:] = above[:, :-channels]
+
+    def apply(kind):
+        if kind == "none":
+            return rows
+        if kind == "sub":
+            return rows - left
+        if kind == "up":
+            return rows - above
+        if kind == "avg":
+            return rows - ((left.astype(np.uint16) + above) >> 1).astype(np.uint8)
+        a, b, c = left.astype(np.int16), above.astype(np.int16), corner.astype(np.int16)
+        pa = np.abs(b - c)
+        pb = np.abs(a - c)
+        pc = np.abs(a + b - 2 * c)
+        predictor = np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c)).astype(np.uint8)
+        return rows - predictor
+
+    if method != "adaptive":
+        filtered[:, 0] = png_filter_types[method]
+        filtered[:, 1:] = apply(method)
+        return filtered
+
+    best = None
+    for kind in ("none", "sub", "up", "avg", "paeth"):
+        candidate = apply(kind)
+        score = np.abs(candidate.view(np.int8).astype(np.int32)).sum(axis=1)
+        if best is None:
+            best = score
+            filtered[:, 0] = png_filter_types[kind]
+            filtered[:, 1:] = candidate
+            continue
+        better = score < best
+        best = np.where(better, score, best)
+        filtered[better, 0] = png_filter_types[kind]
+        filtered[better, 1:] = candidate[better]
+    return filtered
+
+def png_unfilter(filtered, previous=None, channels=4):
+    '''
+    Reverses png_filter(): turns the (rows, 1 + row bytes) filtered rows of a png IDAT stream, with any mix of filter types,
+    back into a (rows, width, channels) uint8 image.
+    previous is the last row of the strip above when an image is unfiltered a strip at a time.
+    Sub, Avg and Paeth need the pixel to the left unfiltered first, so the rows are worked through together along their anti-diagonals:
+    each pixel only depends on pixels of the two anti-diagonals before it. The rows are skewed so each anti-diagonal is a contiguous
+    column of the working array, and each step does one pixel of every row.
+    '''
+    height = filtered.shape[0]
+    data = filtered[:, 1:].reshape(height, -1, channels)
+    width = data.shape[1]
+
+    def unskewed(skewed, first):
+        # the (rows, width, channels) view of skewed from row first, in which pixel x of row r is skewed[x + r + 1, r]
+        rows = skewed.transpose(1, 0, 2)[first:, first + 1:]
+        return np.lib.stride_tricks.as_strided(rows, shape=(height + 1 - first, width, channels),
+                                               strides=(rows.strides[0] + rows.strides[1],) + rows.strides[1:])
+
+    # row 0 is the row above the strip, and the pixel to the left of every row is zero
+    skewed = np.zeros((width + height + 1, height + 1, channels), np.int16)
+    if previous is not None:
+        unskewed(skewed, 0)[0] = previous.reshape(width, channels)
+    differences = np.zeros_like(skewed)
+    unskewed(differences, 1)[:] = data
+    kinds = np.concatenate(([png_filter_types["none"]], filtered[:, 0]))[:, np.newaxis]
+    sub, up, avg, paeth = [kinds == png_filter_types[kind] for kind in ("sub", "up", "avg", "paeth")]
+
+    for diagonal in xrange(2, width + height + 1):
+        first = max(1, diagonal - width)
+        last = min(height + 1, diagonal)
+        # the unfiltered bytes to the left (a), above (b) and above and to the left (c), as in png_filter()
+        a = skewed[diagonal - 1, first:last]
+        b = skewed[diagonal - 1, first - 1:last - 1]
+        c = skewed[diagonal - 2, first - 1:last - 1]
+        pa = np.abs(b - c)
+        pb = np.abs(a - c)
+        pc = np.abs(a + b - 2 * c)
+        predictor = np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+        predictor = np.where(paeth[first:last], predictor, np.where(avg[first:last], (a + b) >> 1, np.where(up[first:last], b, a * sub[first:last])))
+        predictor += differences[diagonal, first:last]
+        predictor &= 255
+        skewed[diagonal, first:last] = predictor
+    return unskewed(skewed, 1).astype(np.uint8)
+
+def adler32_combine(first, second, second_length):
+    '''
+    The adler32 of two pieces of data joined together from the adler32 of each piece and the length of the second, as zlib's adler32_combine.
+    '''
+    base = 65521
+    remainder = second_length % base
+    sum1 = first & 0xffff
+    sum2 = (remainder * sum1) % base
+    sum1 += (second & 0xffff) + base - 1
+    sum2 += ((first >> 16) & 0xffff) + ((second >> 16) & 0xffff) + base - remainder
+    sum1 %= base
+    sum2 %= base
+    return sum1 | (sum2 << 16)
+
+def deflate_chunk(data, level, strategy, last):
+    '''
+    Raw deflates one chunk of a stream that is compressed in pieces. Every chunk but the last ends on a byte boundary with a sync flush
+    so the chunks can simply be joined. Returns the compressed chunk, the adler32 and the length of the data.
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 8, strategy)
+    compressed = compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return compressed, zlib.adler32(data) & 0xffffffff, len(data)
+
+def png_idat(pixels, level, method="up", strategy=zlib.Z_DEFAULT_STRATEGY, threads=1, pool=None):
+    '''
+    Filters and zlib compresses an image into the data of a png IDAT stream.
+    The pdf writer reuses this stream as it is, so the image is only compressed once for both.
+    With more than one thread the image is filtered and deflated in chunks of encode_chunk_rows rows at the same time, zlib lets go of the GIL while it works.
+    The chunks are joined into one zlib stream with a header for the level and the combined adler32 of the chunks, as pigz does.
+    Each chunk starts without the previous chunk as its dictionary, so the output is a little bigger than from one thread.
+    pool is a thread pool to use, otherwise one is started.
+    '''
+    height = pixels.shape[0]
+    if threads <= 1 or height <= encode_chunk_rows:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 15, 8, strategy)
+        return compressor.compress(png_filter(pixels, method=method).tostring()) + compressor.flush()
+
+    def chunk(top):
+        bottom = min(top + encode_chunk_rows, height)
+        previous = pixels[top - 1] if top > 0 else None
+        data = png_filter(pixels[top:bottom], previous, method).tostring()
+        return deflate_chunk(data, level, strategy, bottom == height)
+
+    own_pool = pool == None
+    if own_pool:
+        pool = multiprocessing.pool.ThreadPool(threads)
+    try:
+        chunks = pool.map(chunk, xrange(0, height, encode_chunk_rows))
+    finally:
+        if own_pool:
+            pool.close()
+    checksum = 1
+    for compressed, adler, length in chunks:
+        checksum = adler32_combine(checksum, adler, length)
+    # the zlib header says how hard the stream was compressed, the same as zlib.compress writes
+    header = "\x78" + {0 : "\x01", 1 : "\x5e", 2 : "\x9c", 3 : "\xda"}[0 if level < 2 else 1 if level < 6 else 2 if level == 6 else 3]
+    return header + "".join(compressed for compressed, adler, length in chunks) + struct.pack(">I", checksum)
+
+def encode_settings():
+    '''
+    The settings of the encode_mode picked with --encode.
+    '''
+    return encode_modes[encode_mode]
+
+def png_chunk(kind, data):
+    '''
+    A png chunk: length, type, data and the crc of the type and data.
+    '''
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+def write_png(file_name, pixels, idat, dpi):
+    '''
+    Writes an 8 bit RGB or RGBA png from its already compressed IDAT stream.
+    '''
+    height, width, channels = pixels.shape
+    colour_type = {3 : 2, 4 : 6}[channels]
+    pixels_per_metre = int(round(dpi / 0.0254))
+    with open(file_name, "wb") as handle:
+        handle.write(PNG_SIGNATURE)
+        handle.write(png_chunk("IHDR", struct.pack(">IIBBBBB", width, height, 8, colour_type, 0, 0, 0)))
+        handle.write(png_chunk("pHYs", struct.pack(">IIB", pixels_per_metre, pixels_per_metre, 1)))
+        for start in xrange(0, len(idat), 1 << 23):
+            handle.write(png_chunk("IDAT", idat[start:start + (1 << 23)]))
+        handle.write(png_chunk("IEND", ""))
     return None
 
+def png_header(handle):
+    '''
+    Reads the signature and IHDR chunk of the png open in handle and returns its width, height and channels.
+    Only 8 bit RGB and RGBA pngs without interlacing, as PyMOL and matplotlib write, can be read a strip at a time by png_strips().
+    '''
+    if handle.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+        raise ValueError(handle.name+" is not a png")
+    length, kind = struct.unpack(">I4s", handle.read(8))
+    if kind != "IHDR":
+        raise ValueError(handle.name+" does not start with an IHDR chunk")
+    width, height, depth, colour_type, compression, filter_method, interlace = struct.unpack(">IIBBBBB", handle.read(length)[:13])
+    handle.read(4)
+    if depth != 8 or colour_type not in (2, 6) or interlace != 0:
+        raise ValueError(handle.name+" is not an 8 bit RGB or RGBA png without interlacing, so it cannot be read a strip at a time")
+    return width, height, {2 : 3, 6 : 4}[colour_type]
+
+def png_idat_blocks(handle, block=1 << 20):
+    '''
+    Yields the compressed IDAT stream of the png open in handle, read up to its IHDR chunk by png_header(), in blocks of at most block bytes.
+    Every other chunk is skipped.
+    '''
+    while True:
+        header = handle.read(8)
+        if len(header) < 8:
+            raise IOError(handle.name+" ends before its IEND chunk")
+        length, kind = struct.unpack(">I4s", header)
+        if kind == "IEND":
+            return
+        if kind != "IDAT":
+            handle.seek(length + 4, 1)
+            continue
+        while length > 0:
+            data = handle.read(min(length, block))
+            if not data:
+                raise IOError(handle.name+" ends in the middle of an IDAT chunk")
+            length -= len(data)
+            yield data
+        handle.read(4)
+
+def png_strips(handle, width, channels, rows):
+    '''
+    Decodes the png open in handle, read up to its IHDR chunk by png_header(), and yields it as uint8 arrays of rows rows at a time.
+    The IDAT stream is only inflated as far as the end of the next strip, which is then unfiltered by png_unfilter(),
+    so no more than one strip of the image is ever held in memory.
+    '''
+    inflate = zlib.decompressobj()
+    row_bytes = 1 + width * channels
+    wanted = rows * row_bytes
+    pieces = []
+    size = 0
+    previous = None
+    for data in png_idat_blocks(handle):
+        while data:
+            piece = inflate.decompress(data, wanted - size)
+            data = inflate.unconsumed_tail
+            pieces.append(piece)
+            size += len(piece)
+            if size == wanted:
+                strip = png_unfilter(np.frombuffer("".join(pieces), np.uint8).reshape(rows, row_bytes), previous, channels)
+                previous = strip[-1]
+                pieces = []
+                size = 0
+                yield strip
+    pieces.append(inflate.flush())
+    left_over = "".join(pieces)
+    if left_over:
+        yield png_unfilter(np.frombuffer(left_over, np.uint8).reshape(-1, row_bytes), previous, channels)
+
+def write_pdf(file_name, pixels, idat, dpi):
+    '''
+    Writes a one page pdf of an RGB image at dpi.
+    The png IDAT stream is embedded as it is: pdf FlateDecode with the png predictors reads png filtered rows, so nothing is compressed twice.
+    '''
+    height, width, channels = pixels.shape
+    page_width = width * 72.0 / dpi
+    page_height = height * 72.0 / dpi
+    content = "q %.4f 0 0 %.4f 0 0 cm /Im0 Do Q" % (page_width, page_height)
+    objects = [ "<< /Type /Catalog /Pages 2 0 R >>",
+                "<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+                "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.4f %.4f] /Resources << /XObject << /Im0 4 0 R >> >> /Contents 5 0 R >>" % (page_width, page_height),
+                "<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /FlateDecode "
+                "/DecodeParms << /Predictor 15 /Colors 3 /BitsPerComponent 8 /Columns %d >> /Length %d >>\nstream\n" % (width, height, width, len(idat)) + idat + "\nendstream",
+                "<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content)
+              ]
+    with open(file_name, "wb") as handle:
+        handle.write("%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        offsets = []
+        for number, body in enumerate(objects):
+            offsets.append(handle.tell())
+            handle.write("%d 0 obj\n" % (number + 1) + body + "\nendobj\n")
+        xref = handle.tell()
+        handle.write("xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        for offset in offsets:
+            handle.write("%010d 00000 n \n" % offset)
+        handle.write("trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+    return None
+
+def write_pil(file_name, pixels, file_format, settings):
+    '''
+    Writes the formats png, pdf and tiff do not cover (webp and the jpeg preview) with Pillow, which is only needed if they are asked for.
+    A "thumbnail" setting shrinks the image to fit in a square of that many pixels first.
+    '''
+    try:
+        from PIL import Image
+    except ImportError:
+        raise ImportError("Pillow is needed to write "+file_format+" files. Install it or leave "+file_format+" out of --formats.")
+    image = Image.fromarray(pixels)
+    settings = dict(settings)
+    thumbnail = settings.pop("thumbnail", None)
+    if thumbnail != None:
+        image.thumbnail((thumbnail, thumbnail), Image.LANCZOS)
+    image.save(file_name, format=file_format.upper(), dpi=(page_dpi, page_dpi), **settings)
+    return None
+
+class PngStream(object):
+    '''
+    Writes an 8 bit RGB png a strip of rows at a time with the filter, level and strategy in settings (see encode_modes).
+    The IDAT stream is split into chunks the same way as write_png(), so with one encode thread the file is the same as the one written from the whole page.
+    The compressed stream can also be passed on to a PdfStream.
+    '''
+    def __init__(self, file_name, width, height, dpi, settings, pdf=None):
+        self.handle = None if file_name == None else open(file_name, "wb")
+        self.pdf = pdf
+        self.method = settings["filter"]
+        self.compressor = zlib.compressobj(settings["level"], zlib.DEFLATED, 15, 8, settings["strategy"])
+        self.previous = None
+        self.pending = ""
+        if self.handle != None:
+            pixels_per_metre = int(round(dpi / 0.0254))
+            self.handle.write(PNG_SIGNATURE)
+            self.handle.write(png_chunk("IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+            self.handle.write(png_chunk("pHYs", struct.pack(">IIB", pixels_per_metre, pixels_per_metre, 1)))
+
+    def write(self, rows):
+        self.idat(self.compressor.compress(png_filter(rows, self.previous, self.method).tostring()))
+        self.previous = rows[-1].copy()
+
+    def idat(self, data):
+        if self.pdf != None:
+            self.pdf.write(data)
+        if self.handle == None:
+            return
+        self.pending += data
+        while len(self.pending) >= 1 << 23:
+            self.handle.write(png_chunk("IDAT", self.pending[:1 << 23]))
+            self.pending = self.pending[1 << 23:]
+
+    def close(self):
+        self.idat(self.compressor.flush())
+        if self.handle != None:
+            if self.pending:
+                self.handle.write(png_chunk("IDAT", self.pending))
+            self.handle.write(png_chunk("IEND", ""))
+            self.handle.close()
+        if self.pdf != None:
+            self.pdf.close()
+
+class PdfStream(object):
+    '''
+    Writes the same one page pdf as write_pdf() from the png IDAT stream as it is compressed, see PngStream.
+    The length of the image stream is not known until the end, so it is written as an object after the stream.
+    '''
+    def __init__(self, file_name, width, height, dpi):
+        page_width = width * 72.0 / dpi
+        page_height = height * 72.0 / dpi
+        self.handle = open(file_name, "wb")
+        self.handle.write("%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        self.offsets = []
+        self.content = "q %.4f 0 0 %.4f 0 0 cm /Im0 Do Q" % (page_width, page_height)
+        self.object("<< /Type /Catalog /Pages 2 0 R >>")
+        self.object("<< /Type /Pages /Kids [3 0 R] /Count 1 >>")
+        self.object("<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.4f %.4f] /Resources << /XObject << /Im0 4 0 R >> >> /Contents 5 0 R >>" % (page_width, page_height))
+        self.offsets.append(self.handle.tell())
+        self.handle.write("4 0 obj\n<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /FlateDecode "
+                          "/DecodeParms << /Predictor 15 /Colors 3 /BitsPerComponent 8 /Columns %d >> /Length 6 0 R >>\nstream\n" % (width, height, width))
+        self.length = 0
+
+    def object(self, body):
+        self.offsets.append(self.handle.tell())
+        self.handle.write("%d 0 obj\n" % len(self.offsets) + body + "\nendobj\n")
+
+    def write(self, data):
+        self.handle.write(data)
+        self.length += len(data)
+
+    def close(self):
+        self.handle.write("\nendstream\nendobj\n")
+        self.object("<< /Length %d >>\nstream\n%s\nendstream" % (len(self.content), self.content))
+        self.object("%d" % self.length)
+        xref = self.handle.tell()
+        self.handle.write("xref\n0 %d\n0000000000 65535 f \n" % (len(self.offsets) + 1))
+        for offset in self.offsets:
+            self.handle.write("%010d 00000 n \n" % offset)
+        self.handle.write("trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(self.offsets) + 1, xref))
+        self.handle.close()
+
+class TiffStream(object):
+    '''
+    Writes an 8 bit RGB tiff a strip of rows at a time, without Pillow.
+    The image is stored in strips of strip_rows rows, or with tile as tiles of tile x tile pixels in a BigTIFF,
+    which has 64 bit offsets so it can go past 4 GB. The directory of strip or tile offsets is written at the end.
+    compression is "tiff_deflate" (zlib, at level) or None. With a thread pool the strips or tiles are compressed in it, a few at a time,
+    and written in order as they finish.
+    '''
+    def __init__(self, file_name, width, height, dpi, compression="tiff_deflate", tile=None, level=6, pool=None):
+        self.handle = open(file_name, "wb")
+        self.width = width
+        self.height = height
+        self.dpi = dpi
+        self.compression = compression
+        self.tile = tile
+        self.big = tile != None
+        self.block = tile if self.big else strip_rows
+        self.buffer = []
+        self.buffered = 0
+        self.offsets = []
+        self.counts = []
+        self.level = level
+        self.pool = pool
+        self.pending = collections.deque()
+        if self.big:
+            self.handle.write("II" + struct.pack("<HHHQ", 43, 8, 0, 0))
+        else:
+            self.handle.write("II" + struct.pack("<HI", 42, 0))
+
+    def write(self, rows):
+        self.buffer.append(rows)
+        self.buffered += rows.shape[0]
+        while self.buffered >= self.block:
+            self.flush(self.block)
+
+    def flush(self, count):
+        rows = np.concatenate(self.buffer) if len(self.buffer) > 1 else self.buffer[0]
+        self.buffer = [rows[count:]] if rows.shape[0] > count else []
+        self.buffered = rows.shape[0] - count
+        rows = rows[:count]
+        if not self.big:
+            self.data(rows)
+            return
+        # tiles always have the full tile size, the edges are padded
+        for left in xrange(0, self.width, self.tile):
+            tile = np.zeros((self.tile, self.tile, 3), np.uint8)
+            part = rows[:, left:left + self.tile]
+            tile[:part.shape[0], :part.shape[1]] = part
+            self.data(tile)
+
+    def data(self, pixels):
+        data = np.ascontiguousarray(pixels).tostring()
+        if self.compression != "tiff_deflate":
+            self.store(data)
+        elif self.pool == None:
+            self.store(zlib.compress(data, self.level))
+        else:
+            self.pending.append(self.pool.apply_async(zlib.compress, (data, self.level)))
+            # only keep a few blocks in flight so the memory used stays small
+            while len(self.pending) > 2 * encode_threads:
+                self.store(self.pending.popleft().get())
+
+    def store(self, data):
+        self.offsets.append(self.handle.tell())
+        self.counts.append(len(data))
+        self.handle.write(data)
+
+    def close(self):
+        if self.buffered:
+            self.flush(self.buffered)
+        while self.pending:
+            self.store(self.pending.popleft().get())
+        big = self.big
+        offset_type, offset_format = (16, "Q") if big else (4, "I")
+        resolution = struct.pack("<II", int(round(self.dpi)), 1)
+        entries = [ (256, 4, [self.width]),
+                    (257, 4, [self.height]),
+                    (258, 3, [8, 8, 8]),
+                    (259, 3, [8 if self.compression == "tiff_deflate" else 1]),
+                    (262, 3, [2]),
+                    (277, 3, [3]),
+                    (282, 5, resolution),
+                    (283, 5, resolution),
+                    (284, 3, [1]),
+                    (296, 3, [2])
+                  ]
+        if big:
+            entries += [(322, 4, [self.tile]), (323, 4, [self.tile]), (324, offset_type, self.offsets), (325, offset_type, self.counts)]
+        else:
+            entries += [(273, offset_type, self.offsets), (278, 4, [self.block]), (279, offset_type, self.counts)]
+        entries.sort()
+
+        # values which do not fit in an entry go before the directory
+        inline = 8 if big else 4
+        sizes = {3 : "H", 4 : "I", 16 : "Q"}
+        packed = []
+        for tag, kind, values in entries:
+            if kind == 5:
+                value, count = values, 1
+            else:
+                value, count = struct.pack("<"+str(len(values))+sizes[kind], *values), len(values)
+            if len(value) > inline:
+                if self.handle.tell() % 2:
+                    self.handle.write("\0")
+                where = self.handle.tell()
+                self.handle.write(value)
+                value = struct.pack("<"+offset_format, where)
+            packed.append(struct.pack("<HH", tag, kind) + struct.pack("<"+("Q" if big else "I"), count) + value.ljust(inline, "\0"))
+
+        if self.handle.tell() % 2:
+            self.handle.write("\0")
+        directory = self.handle.tell()
+        self.handle.write(struct.pack("<Q" if big else "<H", len(packed)) + "".join(packed) + struct.pack("<"+offset_format, 0))
+        self.handle.seek(8 if big else 4)
+        self.handle.write(struct.pack("<"+offset_format, directory))
+        self.handle.close()
+
+def stream_writers(basename, width, height, formats):
+    '''
+    Opens a streaming writer for every format in formats. Returns a dict of format to file name and the list of writers, each with write(rows) and close().
+    png and pdf share one PngStream so the rows are only compressed once.
+    '''
+    outputs = {}
+    writers = []
+    pdf = None
+    if "pdf" in formats:
+        outputs["pdf"] = basename+".pdf"
+        pdf = PdfStream(outputs["pdf"], width, height, page_dpi)
+    if "png" in formats:
+        outputs["png"] = basename+".png"
+    if "png" in formats or "pdf" in formats:
+        writers.append(PngStream(outputs.get("png"), width, height, page_dpi, encode_settings(), pdf))
+    for file_format in formats:
+        if file_format in ("png", "pdf"):
+            continue
+        if file_format not in ("tiff", "bigtiff"):
+            raise ValueError(file_format+" can not be written in strips, choose from png, pdf, tiff and bigtiff or leave out --strips.")
+        settings = output_settings[file_format]
+        outputs[file_format] = basename+settings["suffix"]
+        writers.append(TiffStream(outputs[file_format], width, height, page_dpi, settings.get("compression"), settings.get("tile"), encode_settings()["level"]))
+    return outputs, writers
+
+def run_threads(tasks):
+    '''
+    Runs each function in tasks in its own thread and waits for them all.
+    zlib and Pillow release the GIL while they compress, so the encoders really do run at the same time.
+    The first exception raised by any task is raised again here.
+    '''
+    errors = []
+    def run(task):
+        try:
+            task()
+        except Exception:
+            errors.append(sys.exc_info())
+    threads = [threading.Thread(target=run, args=(task,)) for task in tasks]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return None
+
+def run_background(task):
+    '''
+    Runs task in a thread and returns a function which waits for it and returns its result.
+    An exception raised by the task is raised again by the function.
+    '''
+    result = {}
+    def run():
+        try:
+            result["value"] = task()
+        except Exception:
+            result["error"] = sys.exc_info()
+    thread = threading.Thread(target=run, name="background")
+    # don't hold up the exit of the script if the render fails
+    thread.daemon = True
+    thread.start()
+    def wait():
+        thread.join()
+        if "error" in result:
+            raise result["error"][0], result["error"][1], result["error"][2]
+        return result["value"]
+    return wait
+
+def write_outputs(page, basename, formats=None):
+    '''
+    Writes the drawn canvas in every format in formats (output_formats by default), each in its own thread with its settings from output_settings.
+    The canvas is opaque so every format is written as RGB. png and pdf share one compressed stream.
+    png, pdf and tiff are compressed in chunks by a pool of encode_threads threads with the settings of encode_mode.
+    The time taken and the size of each file are printed and added to the profile report.
+    Returns a dict of format to file name.
+    '''
+    if formats == None:
+        formats = output_formats
+    pixels = np.ascontiguousarray(page[:, :, :3])
+    settings = encode_settings()
+    pool = multiprocessing.pool.ThreadPool(encode_threads) if encode_threads > 1 else None
+    outputs = {}
+    tasks = []
+
+    def timed(names, task):
+        def run():
+            start = time.time()
+            task()
+            seconds = time.time() - start
+            for name in names:
+                report_encoder(name, outputs[name], seconds)
+        return run
+
+    if "png" in formats or "pdf" in formats:
+        if "png" in formats:
+            outputs["png"] = basename+".png"
+        if "pdf" in formats:
+            outputs["pdf"] = basename+".pdf"
+        def png_and_pdf():
+            idat = png_idat(pixels, settings["level"], settings["filter"], settings["strategy"], encode_threads, pool)
+            if "png" in outputs:
+                write_png(outputs["png"], pixels, idat, page_dpi)
+            if "pdf" in outputs:
+                write_pdf(outputs["pdf"], pixels, idat, page_dpi)
+        tasks.append(timed([name for name in ("png", "pdf") if name in outputs], png_and_pdf))
+
+    for file_format in formats:
+        if file_format in ("png", "pdf"):
+            continue
+        if file_format not in output_settings:
+            raise ValueError("Unknown output format "+file_format+", choose from "+", ".join(sorted(output_settings.keys())))
+        outputs[file_format] = basename+output_settings[file_format]["suffix"]
+        if file_format in ("tiff", "bigtiff"):
+            tasks.append(timed([file_format], lambda file_format=file_format: write_stream(TiffStream(outputs[file_format], pixels.shape[1], pixels.shape[0], page_dpi,
+                                                         output_settings[file_format]["compression"], output_settings[file_format].get("tile"), settings["level"], pool), pixels)))
+            continue
+        pil_settings = dict((k, v) for k, v in output_settings[file_format].items() if k != "suffix")
+        tasks.append(timed([file_format], lambda file_format=file_format, pil_settings=pil_settings: write_pil(outputs[file_format], pixels, file_format, pil_settings)))
+
+    try:
+        run_threads(tasks)
+    finally:
+        if pool != None:
+            pool.close()
+    return outputs
+
+def report_encoder(file_format, file_name, seconds):
+    '''
+    Prints how long a format took to encode and write and how big it is, and keeps it for the profile report.
+    png and pdf share their compressed stream so they are timed together.
+    '''
+    size = os.path.getsize(file_name)
+    encoder_reports.append({"format" : file_format, "mode" : encode_mode, "seconds" : seconds, "bytes" : size, "threads" : encode_threads})
+    print "Encoded "+file_format+" ("+encode_mode+") in "+'%.2f' % seconds+" seconds, "+'%.1f' % (size / 1048576.0)+" MB: "+file_name
+    return None
+
+def write_stream(writer, pixels):
+    '''
+    Feeds an image already in memory through a streaming writer a strip at a time.
+    '''
+    for top in xrange(0, pixels.shape[0], strip_rows):
+        writer.write(pixels[top:top + strip_rows])
+    writer.close()
+    return None
+
+def write_strips(layers, basename, formats=None):
+    '''
+    Composes the canvas a strip of strip_rows rows at a time with compose_rows() and streams each strip into the writers of every format,
+    so the whole page is never in memory. The files match the ones write_outputs() writes from the whole page.
+    Returns a dict of format to file name.
+    '''
+    if formats == None:
+        formats = output_formats
+    outputs, writers = stream_writers(basename, layers["width"], layers["height"], formats)
+    try:
+        for top in xrange(0, layers["height"], strip_rows):
+            rows = np.ascontiguousarray(compose_rows(layers, top, min(top + strip_rows, layers["height"]))[:, :, :3])
+            for writer in writers:
+                writer.write(rows)
+    finally:
+        for writer in writers:
+            writer.close()
+    return outputs
+
+def structure_memmap(image, file_name):
+    '''
+    Puts the structure layer into a uint8 RGBA array memory mapped from file_name, so the canvas can be composed from it a strip at a time.
+    A png is decoded straight into the memmap a strip at a time by png_strips(), so the whole image is never in memory.
+    A uint8 RGBA memmap, as ray_tiled() returns with --strips, is used as it is and any other array is copied in a strip at a time.
+    '''
+    if isinstance(image, np.memmap) and image.dtype == np.uint8 and image.shape[2] == 4:
+        return image
+    if isinstance(image, basestring):
+        with open(image, "rb") as handle:
+            width, height, channels = png_header(handle)
+            mapped = np.lib.format.open_memmap(file_name, mode="w+", dtype=np.uint8, shape=(height, width, 4))
+            top = 0
+            for rows in png_strips(handle, width, channels, strip_rows):
+                if channels == 3:
+                    mapped[top:top + len(rows), :, 3] = 255
+                mapped[top:top + len(rows), :, :channels] = rows
+                top += len(rows)
+        if top != height:
+            raise IOError(image+" has "+str(top)+" rows of image data rather than "+str(height))
+        mapped.flush()
+        del mapped
+        return np.load(file_name, mmap_mode="r")
+
+    mapped = np.lib.format.open_memmap(file_name, mode="w+", dtype=np.uint8, shape=image.shape[:2] + (4,))
+    for top in xrange(0, image.shape[0], strip_rows):
+        rows = image[top:top + strip_rows]
+        if rows.dtype != np.uint8:
+            rows = (rows * 255 + 0.5).astype(np.uint8)
+        if rows.shape[2] == 3:
+            mapped[top:top + strip_rows, :, 3] = 255
+        mapped[top:top + strip_rows, :, :rows.shape[2]] = rows
+    mapped.flush()
+    del mapped
+    return np.load(file_name, mmap_mode="r")
+
+#########################################################################################
+################################## Artwork pipeline #####################################
+
+def prepare_scene(store_entry, chains, colours, transparency, view, width, height):
+    '''
+    Gets the scene ready to render: loads the stored structure as "complex", sorts the chains into coloured objects and shows them
+    at the level of detail detail_policy() picks for rendering view at width x height pixels.
+    With --warm_start the scene is restored from a cached session if there is one, and saved for next time if not.
+    Returns the detail_policy() report.
+    '''
+    global detail_report
+    # Warm start from a cached session of this scene if there is one
+    restored = False
+    if warm_start and render_cache_dir != None:
+        with profile_stage("scene.restore"):
+            inputs = scene_inputs(store_entry["sha256"], chains, colours, transparency, detail_inputs(view, width, height))
+            restored = restore_scene(inputs, chains.keys(), os.path.join(render_cache_dir, "sessions"))
+    if restored:
+        # the session was saved with the same level of detail, its settings are already applied
+        detail_report = detail_policy(scene_atoms(chains.keys()), view, width, height)
+        print_detail(detail_report)
+        return detail_report
+
+    with profile_stage("structure.load"):
+        pymol.cmd.load(store_entry["path"], "complex")
+
+    # load the different chains, colour them and create objects out of each chain
+    with profile_stage("chains.setup"):
+        entities = store_entry["header"].get("entities")
+        # structures added to the store before entities were parsed
+        if entities == None:
+            entities = parse_pdb_info(store_entry["path"])["entities"]
+        setup_chains("complex", chains, colours, entities)
+    detail_report = detail_policy(scene_atoms(chains.keys()), view, width, height)
+    apply_detail(detail_report)
+    with profile_stage("structure.surfaces"):
+        show_structure(chains.keys(), transparency)
+        # PyMOL only builds the surfaces when they are first drawn, a 1 pixel ray makes that happen here so it is timed here
+        if profiling:
+            pymol.cmd.ray(1, 1)
+    if warm_start and render_cache_dir != None:
+        with profile_stage("scene.store"):
+            store_scene(inputs, os.path.join(render_cache_dir, "sessions"), render_cache_size)
+    return detail_report
+
+def scene_atoms(roles):
+    '''
+    Number of atoms in the chain objects which are rendered.
+    '''
+    return sum(pymol.cmd.count_atoms(role+"_obj") for role in roles)
+
+def make_artwork(pdb_id, chains, colours, view, do_ray, outdir=".", transparency=None, masks=False, formats=None):
+    '''
+    Runs the whole pipeline for one entry. This is what the body of the script does for 6R0E and what every batch worker does for each manifest entry.
+    Loads the structure from the local store, sorts the chains into coloured objects, renders the structure layer, parses the plaque info and draws the canvas.
+    With masks=True the structure layer is coloured from an id mask and shading layer (see render_masks()), which are saved as complex_masks.npz for recolouring later.
+    Everything is written into outdir, the canvas in formats (output_formats by default). Returns a dict of the output file names.
+    With do_ray = 0 the structure layer is taken from the render cache, or from a complex_image.png already in outdir. IOError is raised if there is neither.
+    With --profile the timing of every stage is written next to the canvas as canvas_<time>.profile.json, see write_profile().
+    '''
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    start_profile(os.path.join(outdir, "profile"))
+
+    # This creates a new session of PyMOL and runs my favourite viewing parameters for PyMOL
+    # These parameters can be seen in def intialisePymol() function above
+    with profile_stage("pymol.init"):
+        initialisePymol()
+
+    if transparency == None:
+        transparency = transparencySet
+
+    # Load the mmcif file of the structure from the local store. It is only fetched from RCSB if it is not there yet.
+    with profile_stage("structure.fetch"):
+        store_entry = store_get(structure_store_dir, pdb_id, offline)
+
+    # The info for the plaque was parsed from the mmcif file when it was added to the store
+    # so the background and plaque can be drawn while the structure is rendered
+    structure_info = store_entry["header"]
+    canvas_ready = prepare_canvas(structure_info, colours)
+
+    print colours
+
+    # If this exact render has been done before, skip straight to the canvas. With --no_ray this is the render that gets used.
+    image_name = os.path.join(outdir, "complex_image.png")
+    cache_key = None
+    cached = None
+    if render_cache_dir != None and not masks:
+        with profile_stage("cache.lookup"):
+            cache_key = render_cache_key(store_entry["sha256"], chains, colours, view, transparency)
+            cached = cache_lookup(cache_key, render_cache_dir)
+
+    if cached != None:
+        print "Using cached render "+cached
+        with profile_stage("cache.read"):
+            if os.path.abspath(cached) != os.path.abspath(image_name):
+                shutil.copyfile(cached, image_name)
+            complex_image = image_name if strip_output else plt.imread(image_name)
+    else:
+        if not do_ray and not os.path.exists(image_name):
+            raise IOError("--no_ray needs an earlier render of this scene, but there is none in the render cache and no "+image_name)
+        prepare_scene(store_entry, chains, colours, transparency, view, length_to_pixels(image_width, image_dpi), length_to_pixels(image_height, image_dpi))
+
+        # generate the image of the structure using PyMOL
+        if masks and do_ray:
+            structure_layer("complex", 0, roles=chains.keys(), view=view, transparency=transparency, prepared=True)
+            with profile_stage("structure.masks"):
+                complex_masks = render_masks(chains.keys(), saveas=os.path.join(outdir, "complex_masks.npz"))
+                complex_image = recolour_layer(complex_masks, colours)
+                mpimg.imsave(image_name, complex_image)
+        else:
+            complex_image = structure_layer("complex", do_ray, roles=chains.keys(), view=view, transparency=transparency, saveas=image_name, prepared=True)
+        if cache_key != None and do_ray:
+            with profile_stage("cache.store"):
+                cache_store(cache_key, image_name, render_cache_dir, render_cache_size)
+
+    # Place the PyMOL image onto the background and plaque to finish the canvas
+    # the ray traced image is passed in memory. With --no_ray fall back to the last png on disk
+    if complex_image is None:
+        complex_image = image_name
+    with profile_stage("canvas.wait"):
+        layers = canvas_ready()
+    basename = canvas_basename(outdir)
+    outputs = canvas(complex_image, structure_info, colours=colours, outdir=outdir, formats=formats, layers=layers, basename=basename)
+    if compare_compositors:
+        compare_canvas(complex_image, structure_info, colours)
+
+    # save the PyMOL session file so the scene can be opened up again. There is no scene to save if the render came from the cache.
+    outputs["session"] = None
+    if cached == None:
+        outputs["session"] = os.path.join(outdir, pdb_id.upper()+"_artwork.pse")
+        with profile_stage("session.save"):
+            pymol.cmd.save(outputs["session"])
+    if masks and do_ray:
+        outputs["masks"] = os.path.join(outdir, "complex_masks.npz")
+    if profiling:
+        outputs["profile"] = basename+".profile.json"
+        write_profile(outputs["profile"], pdb_id)
+    return outputs
+
+
+def load_manifest(manifest_name):
+    '''
+    Reads a json manifest of entries for run_batch().
+    The manifest is a list (or a dict with an "entries" list) where each entry looks like:
+
+    {"id": "6r0e", "chains": {"HLAA": "AAA", ...}, "view": "...", "colours": {"top": "#acc4ce", ...}, "transparency": {"HLAA": 0.1, ...}}
+
+    Only "id" is required. Missing chains, view and transparency fall back to the defaults at the top of the script
+    and colours are merged over colourSet, so an entry only needs to give the colours it changes.
+    '''
+    with open(manifest_name) as handle:
+        manifest = json.load(handle)
+    if isinstance(manifest, dict):
+        manifest = manifest["entries"]
+
+    return [manifest_entry(item) for item in manifest]
+
+def manifest_entry(item):
+    '''
+    Fills in the defaults of one manifest entry (or daemon job), see load_manifest().
+    An entry can also give the "formats" to write the canvas in.
+    '''
+    entry = {}
+    entry["id"] = str(item["id"]).lower()
+    # chains can also be given as a list of chain ids and entity: or type: terms
+    entry["chains"] = dict((str(k), str(v) if isinstance(v, basestring) else ",".join(str(c) for c in v)) for k, v in item.get("chains", chains_dict).items())
+    entry["view"] = item.get("view", complex_view)
+    # PyMOL takes a view as a string or as a list of 18 floats
+    if not isinstance(entry["view"], basestring):
+        entry["view"] = [float(v) for v in entry["view"]]
+    entry["colours"] = dict(colourSet)
+    entry["colours"].update(dict((str(k), v) for k, v in item.get("colours", {}).items()))
+    entry["transparency"] = dict(transparencySet)
+    entry["transparency"].update(dict((str(k), float(v)) for k, v in item.get("transparency", {}).items()))
+    entry["formats"] = [str(f) for f in item.get("formats", output_formats)]
+    return entry
+
+
+def pymol_worker_init():
+    '''
+    Runs once in each batch or tile worker process so every worker has its own headless PyMOL instance.
+    '''
+    initialisePymol()
+    return None
+
+
+def run_batch_entry(job):
+    '''
+    Makes the artwork for one manifest entry inside a batch worker.
+    Any exception is caught and returned in the result so that one bad entry does not take down the rest of the batch.
+    '''
+    entry, do_ray, outdir = job
+    start = time.time()
+    result = {"id" : entry["id"], "status" : "done", "error" : None}
+    try:
+        result["outputs"] = make_artwork(entry["id"], entry["chains"], entry["colours"], entry["view"], do_ray,
+                                         outdir=os.path.join(outdir, entry["id"]), transparency=entry["transparency"], formats=entry.get("formats"))
+    except Exception:
+        result["status"] = "failed"
+        result["error"] = traceback.format_exc()
+    result["seconds"] = time.time() - start
+    return result
+
+
+def run_batch(entries, do_ray, workers, outdir, timeout=None):
+    '''
+    Spreads the entries of a manifest across a pool of worker processes, each with its own PyMOL instance.
+    PyMOL is only started once per worker rather than once per entry.
+    Each entry gets a sub-directory of outdir and a summary of every entry is written to outdir/batch_summary.json.
+    An entry that has not finished after timeout seconds (ray_timeout by default) is marked as failed.
+    Returns the list of results.
+    '''
+    if timeout == None:
+        timeout = ray_timeout
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    # make sure every structure is in the store before the workers start, so they do not download the same files at once
+    for entry in entries:
+        try:
+            store_get(structure_store_dir, entry["id"], offline)
+        except Exception as error:
+            print "Could not get "+entry["id"]+" into the structure store: "+str(error)
+
+    workers = max(1, min(workers, len(entries)))
+    print "Making artwork for "+str(len(entries))+" entries with "+str(workers)+" workers.."
+    pool = multiprocessing.Pool(workers, initializer=pymol_worker_init)
+    pending = [(entry, pool.apply_async(run_batch_entry, ((entry, do_ray, outdir),))) for entry in entries]
+
+    results = []
+    try:
+        for entry, pending_result in pending:
+            try:
+                result = pending_result.get(timeout)
+            except multiprocessing.TimeoutError:
+                result = {"id" : entry["id"], "status" : "failed", "error" : "Timed out after "+str(timeout)+" seconds", "seconds" : timeout}
+            print entry["id"]+": "+result["status"]+" ("+'%.1f' % result["seconds"]+" seconds)"
+            results.append(result)
+    finally:
+        # terminate rather than close so a hung PyMOL worker cannot block the end of the batch
+        pool.terminate()
+        pool.join()
+
+    with open(os.path.join(outdir, "batch_summary.json"), "w") as handle:
+        json.dump(results, handle, indent=2)
+
+    failed = [result for result in results if result["status"] != "done"]
+    print str(len(results)-len(failed))+" of "+str(len(results))+" entries done. See "+os.path.join(outdir, "batch_summary.json")
+    return results
+
+#########################################################################################
+##################################### Animation #########################################
+
+def view_rotation(view):
+    '''
+    The 3x3 rotation at the start of a PyMOL view. PyMOL stores it column major, so this is the transpose of the matrix.
+    '''
+    return np.array(view_to_list(view)[:9]).reshape(3, 3)
+
+def turn_view(view, axis, angle):
+    '''
+    Turns the camera of a view by angle degrees about the x, y or z axis of the screen, like pymol.cmd.turn does.
+    '''
+    view = view_to_list(view)
+    radians = math.radians(angle)
+    cos, sin = math.cos(radians), math.sin(radians)
+    first, second = {"x" : (1, 2), "y" : (2, 0), "z" : (0, 1)}[axis]
+    turn = np.identity(3)
+    turn[first, first] = cos
+    turn[second, second] = cos
+    turn[first, second] = -sin
+    turn[second, first] = sin
+    view[:9] = view_rotation(view).dot(turn.T).flatten().tolist()
+    return view
+
+def rotation_quaternion(rotation):
+    '''
+    Converts a 3x3 rotation matrix to a unit quaternion (w, x, y, z).
+    '''
+    trace = rotation.trace()
+    if trace > 0:
+        s = math.sqrt(trace + 1.0) * 2
+        quaternion = [0.25 * s, (rotation[2, 1] - rotation[1, 2]) / s, (rotation[0, 2] - rotation[2, 0]) / s, (rotation[1, 0] - rotation[0, 1]) / s]
+    else:
+        i = int(np.argmax(rotation.diagonal()))
+        j, k = (i + 1) % 3, (i + 2) % 3
+        s = math.sqrt(1.0 + rotation[i, i] - rotation[j, j] - rotation[k, k]) * 2
+        quaternion = [0.0, 0.0, 0.0, 0.0]
+        quaternion[0] = (rotation[k, j] - rotation[j, k]) / s
+        quaternion[1 + i] = 0.25 * s
+        quaternion[1 + j] = (rotation[j, i] + rotation[i, j]) / s
+        quaternion[1 + k] = (rotation[k, i] + rotation[i, k]) / s
+    return np.array(quaternion)
+
+def quaternion_rotation(quaternion):
+    '''
+    Converts a unit quaternion (w, x, y, z) back to a 3x3 rotation matrix.
+    '''
+    w, x, y, z = quaternion / np.linalg.norm(quaternion)
+    return np.array([[1 - 2*(y*y + z*z), 2*(x*y - z*w), 2*(x*z + y*w)],
+                     [2*(x*y + z*w), 1 - 2*(x*x + z*z), 2*(y*z - x*w)],
+                     [2*(x*z - y*w), 2*(y*z + x*w), 1 - 2*(x*x + y*y)]])
+
+def interpolate_views(first, second, fraction):
+    '''
+    The view fraction of the way from first to second. The rotation is interpolated along the shortest arc (slerp),
+    the camera position, origin and clipping planes linearly.
+    '''
+    first = view_to_list(first)
+    second = view_to_list(second)
+    start = rotation_quaternion(view_rotation(first))
+    end = rotation_quaternion(view_rotation(second))
+    dot = float(np.dot(start, end))
+    if dot < 0:
+        end = -end
+        dot = -dot
+    if dot > 0.9995:
+        quaternion = start + fraction * (end - start)
+    else:
+        angle = math.acos(dot)
+        quaternion = (math.sin((1 - fraction) * angle) * start + math.sin(fraction * angle) * end) / math.sin(angle)
+    view = quaternion_rotation(quaternion).flatten().tolist()
+    view += [a + fraction * (b - a) for a, b in zip(first[9:], second[9:])]
+    return view
+
+def animation_views(view, mode, frames):
+    '''
+    The view of every frame of the animation, all starting from view (the stored complex_image scene).
+    "turntable" turns the camera a full circle about animation_axis. "flythrough" moves smoothly through animation_keyframes,
+    which are given as functions of the starting view, and back to the start so the animation loops.
+    '''
+    if mode == "turntable":
+        return [turn_view(view, animation_axis, 360.0 * frame / frames) for frame in xrange(frames)]
+
+    keyframes = [view_to_list(view)] + [keyframe(view_to_list(view)) for keyframe in animation_keyframes] + [view_to_list(view)]
+    views = []
+    for frame in xrange(frames):
+        position = frame * (len(keyframes) - 1) / float(frames)
+        index = int(position)
+        # ease in and out of every keyframe
+        fraction = position - index
+        fraction = fraction * fraction * (3 - 2 * fraction)
+        views.append(interpolate_views(keyframes[index], keyframes[index + 1], fraction))
+    return views
+
+def zoom_view(view, factor, axis="y", angle=0.0):
+    '''
+    Moves the camera of a view factor of the way towards the origin, moving the clipping planes with it, and turns it by angle.
+    '''
+    view = turn_view(view, axis, angle)
+    distance = view[11] * factor
+    view[15] += distance
+    view[16] += distance
+    view[11] -= distance
+    return view
+
+def animation_encoder(file_name, width, height, file_format):
+    '''
+    Starts ffmpeg reading raw RGB frames of width x height from a pipe and encoding them into file_name.
+    Returns the process, frames are written to its stdin.
+    '''
+    settings = animation_settings[file_format]
+    command = [ffmpeg_binary, "-y", "-loglevel", "error",
+               "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", str(width)+"x"+str(height), "-r", str(animation_fps), "-i", "-"] + settings["codec"] + [file_name]
+    try:
+        return subprocess.Popen(command, stdin=subprocess.PIPE)
+    except OSError:
+        raise OSError(ffmpeg_binary+" could not be started. It is needed to encode animations, install it or point ffmpeg_binary at it.")
+
+def make_animation(pdb_id, chains, colours, view, outdir=".", mode="turntable", frames=None, file_format=None, transparency=None, timeout=None):
+    '''
+    Makes a turntable or fly-through animation of the artwork. The scene is prepared as for make_artwork() and saved as a session,
+    then every frame is ray traced by a worker of render_pool and composited onto the canvas background and plaque at animation_dpi.
+    Frames are streamed into ffmpeg in order as soon as they arrive and only animation_window frames are in flight at once,
+    so memory use does not grow with the number of frames and no frame is written to disk.
+    render_pool has to have been started with start_render_pool() before PyMOL was launched. Returns the file name of the animation.
+    '''
+    if frames == None:
+        frames = animation_frames
+    if file_format == None:
+        file_format = animation_format
+    if transparency == None:
+        transparency = transparencySet
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    initialisePymol()
+    store_entry = store_get(structure_store_dir, pdb_id, offline)
+    # the background and plaque are drawn once while the scene is set up, only the structure layer changes between frames
+    layers_ready = run_background(lambda: canvas_layers(None, store_entry["header"], colours, dpi=animation_dpi))
+    width = length_to_pixels(image_width, animation_dpi)
+    height = length_to_pixels(image_height, animation_dpi)
+    prepare_scene(store_entry, chains, colours, transparency, view, width, height)
+    pymol.cmd.set_view(view)
+    pymol.cmd.scene("complex_image", "store")
+
+    handle, session_name = tempfile.mkstemp(suffix=".pse")
+    os.close(handle)
+    pymol.cmd.save(session_name)
+    session_id = uuid.uuid4().hex
+
+    layers = layers_ready()
+    # most video codecs need an even frame size
+    page_width = layers["width"] - layers["width"] % 2
+    page_height = layers["height"] - layers["height"] % 2
+
+    file_name = os.path.join(outdir, pdb_id.upper()+"_"+mode+animation_settings[file_format]["suffix"])
+    jobs = iter([(session_name, session_id, frame_view, width, height, timeout) for frame_view in animation_views(view, mode, frames)])
+    print "Rendering "+str(frames)+" frames of "+str(page_width)+"x"+str(page_height)+" into "+file_name+".."
+    start = time.time()
+    encoder = animation_encoder(file_name, page_width, page_height, file_format)
+    in_flight = collections.deque()
+    try:
+        for job in itertools.islice(jobs, animation_window):
+            in_flight.append(render_pool.apply_async(render_tile, (job,)))
+        done = 0
+        while in_flight:
+            frame = in_flight.popleft().get(timeout)
+            # keep the window full while this frame is composited and encoded
+            for job in itertools.islice(jobs, 1):
+                in_flight.append(render_pool.apply_async(render_tile, (job,)))
+            layers["overlays"].append(structure_overlay(frame, layers["height"], animation_dpi))
+            page = compose_page(layers)
+            layers["overlays"].pop()
+            encoder.stdin.write(page[:page_height, :page_width, :3].tostring())
+            done += 1
+            if done % 10 == 0 or done == frames:
+                print str(done)+"/"+str(frames)+" frames, "+'%.1f' % (done / (time.time() - start))+" frames per second"
+    finally:
+        encoder.stdin.close()
+        encoder.wait()
+        os.remove(session_name)
+    if encoder.returncode != 0:
+        raise RuntimeError("ffmpeg failed to encode "+file_name)
+    print "Done! "+file_name+" was outputted"
+    return file_name
+
+#########################################################################################
+################################### Views and sizes #####################################
+
+def resolve_view(name):
+    '''
+    The PyMOL view of a named view from named_views, as a list of 18 floats.
+    '''
+    if name not in named_views:
+        raise ValueError("Unknown view "+name+", choose from "+", ".join(sorted(named_views)))
+    view = named_views[name]
+    if isinstance(view, dict):
+        axis, angle = view["turn"]
+        return turn_view(resolve_view(view["from"]), axis, angle)
+    return view_to_list(view)
+
+def size_pixels(size):
+    '''
+    Width and height in pixels of a size from output_sizes.
+    '''
+    settings = output_sizes[size]
+    return length_to_pixels(settings["width"], settings["dpi"]), length_to_pixels(settings["height"], settings["dpi"])
+
+def render_draft(view, file_name, timeout=None):
+    '''
+    Ray traces a quick draft_width pixel preview of view with antialiasing off. It only takes a moment, so it is done even with --no_ray.
+    '''
+    width, height = size_pixels("poster")
+    antialias = pymol.cmd.get("antialias")
+    pymol.cmd.set("antialias", 0)
+    pymol.cmd.set_view(view)
+    try:
+        pymol.cmd.png(file_name, width=draft_width, height=int(round(draft_width * height / float(width))), ray=1)
+        pymol.cmd.sync(timeout)
+        wait4ray(file_name, timeout)
+    finally:
+        pymol.cmd.set("antialias", antialias)
+    print "Draft preview written to "+file_name
+    return file_name
+
+def render_view(job):
+    '''
+    Ray traces one view at one size in this process and returns it as a uint8 RGBA array, like render_tile() does in a worker.
+    '''
+    session_name, session_id, view, width, height, timeout = job
+    pymol.cmd.set_view(view)
+    file_name = ray_temp_name()
+    try:
+        pymol.cmd.png(file_name, width=width, height=height, ray=1)
+        pymol.cmd.sync(timeout)
+        wait4ray(file_name, timeout)
+        image = plt.imread(file_name)
+    finally:
+        if os.path.exists(file_name):
+            os.remove(file_name)
+    return (image * 255 + 0.5).astype(np.uint8)
+
+def make_renders(pdb_id, chains, colours, views, sizes, do_ray, outdir=".", transparency=None, formats=None, timeout=None):
+    '''
+    Renders every view in views at every size in sizes from one loaded scene. The structure is loaded, sorted into chains and surfaced once,
+    then saved with PyMOL's cache of the surfaces so the render workers only have to ray trace.
+    A quick draft of the first view is rendered first so there is something to look at straight away, and it is all that is done with do_ray = 0.
+    With render_pool started the views and sizes are ray traced in parallel, otherwise one after the other here.
+    Each render is written to outdir/<view>/<size>.png and the poster size is also made into the canvas there.
+    Returns a dict of the output file names.
+    '''
+    if transparency == None:
+        transparency = transparencySet
+    if timeout == None:
+        timeout = ray_timeout
+    view_lists = [(name, resolve_view(name)) for name in views]
+    pixels = dict((size, size_pixels(size)) for size in sizes)
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    initialisePymol()
+    store_entry = store_get(structure_store_dir, pdb_id, offline)
+    canvas_ready = prepare_canvas(store_entry["header"], colours)
+    largest = max(pixels.values(), key=lambda size: size[0] * size[1])
+    prepare_scene(store_entry, chains, colours, transparency, view_lists[0][1], largest[0], largest[1])
+
+    outputs = {"draft" : render_draft(view_lists[0][1], os.path.join(outdir, "draft.png"), timeout)}
+    if not do_ray:
+        return outputs
+
+    # the surfaces are computed now and kept in the session, so the workers do not build them again
+    pymol.cmd.cache("enable")
+    pymol.cmd.scene("complex_image", "store")
+    pymol.cmd.cache("optimize", "complex_image")
+    handle, session_name = tempfile.mkstemp(suffix=".pse")
+    os.close(handle)
+    pymol.cmd.save(session_name)
+    session_id = uuid.uuid4().hex
+
+    renders = [(name, view, size) for name, view in view_lists for size in sizes]
+    jobs = [(session_name, session_id, view, pixels[size][0], pixels[size][1], timeout) for name, view, size in renders]
+    print "Ray tracing "+str(len(jobs))+" renders of "+str(len(views))+" views at "+", ".join(sizes)+".."
+    if render_pool != None:
+        images = render_pool.imap(render_tile, jobs)
+    else:
+        images = itertools.imap(render_view, jobs)
+
+    layers = None
+    try:
+        for (name, view, size), image in itertools.izip(renders, images):
+            view_dir = os.path.join(outdir, name)
+            if not os.path.isdir(view_dir):
+                os.makedirs(view_dir)
+            outputs[name+"/"+size] = os.path.join(view_dir, size+".png")
+            settings = encode_settings()
+            write_png(outputs[name+"/"+size], image, png_idat(image, settings["level"], settings["filter"], settings["strategy"], encode_threads), output_sizes[size]["dpi"])
+            print "Done! "+outputs[name+"/"+size]+" was outputted"
+            if output_sizes[size]["canvas"]:
+                if layers == None:
+                    layers = canvas_ready()
+                outputs[name+"/canvas"] = canvas(image, store_entry["header"], colours=colours, outdir=view_dir, formats=formats, layers=layers)
+    finally:
+        os.remove(session_name)
+    return outputs
+
+#########################################################################################
+#################################### Render daemon ######################################
+
+# counters and recent job timings of the render daemon, shared by its connection threads
+daemon_stats = {    "in_flight" :   0,
+                    "completed" :   0,
+                    "failed"    :   0,
+                    "rejected"  :   0,
+                    "timings"   :   collections.deque(maxlen=200)
+               }
+daemon_lock = threading.Lock()
+
+def daemon_entry(job):
+    '''
+    Runs one daemon job in a pool worker, see run_batch_entry(). While it runs, the worker's pid and start time are kept in the shared
+    running dict under the job id, so the daemon can kill a worker whose render hangs.
+    '''
+    entry, do_ray, outdir, job_id, running = job
+    running[job_id] = (os.getpid(), time.time())
+    try:
+        return run_batch_entry((entry, do_ray, outdir))
+    finally:
+        running.pop(job_id, None)
+
+def daemon_wait(server, pending, job_id, entry):
+    '''
+    Waits for a daemon job to finish. Time spent queued for a worker does not count, but once the job has been rendering for ray_timeout seconds
+    its worker is killed. The pool starts a fresh worker in its place and the job is returned as failed.
+    '''
+    while not pending.ready():
+        pending.wait(1.0)
+        started = server.running.get(job_id)
+        if started == None or time.time() - started[1] < ray_timeout:
+            continue
+        try:
+            os.kill(started[0], signal.SIGKILL)
+        except OSError:
+            pass
+        server.running.pop(job_id, None)
+        print "Killed worker "+str(started[0])+" after "+entry["id"]+" rendered for "+str(ray_timeout)+" seconds"
+        return {"id" : entry["id"], "status" : "failed", "error" : "Timed out after "+str(ray_timeout)+" seconds, the worker was replaced", "seconds" : ray_timeout}
+    return pending.get()
+
+class DaemonHandler(SocketServer.StreamRequestHandler):
+    '''
+    One connection to the render daemon. Each line sent is a json request and gets one json line back, see daemon_request().
+    '''
+    def handle(self):
+        for line in iter(self.rfile.readline, ""):
+            try:
+                response = daemon_respond(self.server, json.loads(line))
+            except Exception:
+                response = {"status" : "error", "error" : traceback.format_exc()}
+            self.wfile.write(json.dumps(response)+"\n")
+            self.wfile.flush()
+
+def daemon_metrics(server):
+    '''
+    Queue depth, job counts and per-job timings of the render daemon.
+    '''
+    with daemon_lock:
+        timings = list(daemon_stats["timings"])
+        metrics = dict((name, daemon_stats[name]) for name in ["in_flight", "completed", "failed", "rejected"])
+    metrics["workers"] = server.workers
+    metrics["queue_depth"] = max(0, metrics["in_flight"] - server.workers)
+    metrics["queue_size"] = server.queue_size
+    for name in ["wait", "render", "total"]:
+        values = sorted(timing[name] for timing in timings)
+        if values:
+            metrics[name+"_seconds"] = {"mean" : sum(values)/len(values), "p50" : values[len(values)//2], "p95" : values[int(len(values)*0.95)], "max" : values[-1]}
+    metrics["recent"] = timings[-10:]
+    return metrics
+
+def daemon_respond(server, request):
+    '''
+    Handles one request to the render daemon:
+    {"command": "render", "job": {...manifest entry...}, "ray": true, "outdir": "..."} makes the artwork and replies with the outputs and timings,
+    {"command": "stats"} replies with daemon_metrics().
+    If the queue is full a render is turned away at once with status "busy", so clients back off rather than pile up.
+    A job counts towards the queue until its worker has really finished with it or been killed, see daemon_wait().
+    A render without "ray" needs the render cache, as for --batch.
+    '''
+    command = request.get("command", "render")
+    if command == "stats":
+        return {"status" : "done", "stats" : daemon_metrics(server)}
+    if command != "render":
+        raise ValueError("Unknown command "+str(command))
+    if not request.get("ray", True) and render_cache_dir == None:
+        return {"status" : "error", "error" : "A render without ray reuses the cached render, but the daemon was started with --no_cache"}
+
+    with daemon_lock:
+        if daemon_stats["in_flight"] >= server.workers + server.queue_size:
+            daemon_stats["rejected"] += 1
+            return {"status" : "busy", "queue_depth" : daemon_stats["in_flight"] - server.workers}
+        daemon_stats["in_flight"] += 1
+
+    start = time.time()
+    try:
+        entry = manifest_entry(request["job"])
+        do_ray = 1 if request.get("ray", True) else 0
+        outdir = str(request.get("outdir", server.outdir))
+        job_id = uuid.uuid4().hex
+        pending = server.pool.apply_async(daemon_entry, ((entry, do_ray, outdir, job_id, server.running),))
+        result = daemon_wait(server, pending, job_id, entry)
+    finally:
+        with daemon_lock:
+            daemon_stats["in_flight"] -= 1
+
+    total = time.time() - start
+    timing = {"id" : result["id"], "render" : result["seconds"], "wait" : max(0.0, total - result["seconds"]), "total" : total}
+    with daemon_lock:
+        daemon_stats["completed" if result["status"] == "done" else "failed"] += 1
+        daemon_stats["timings"].append(timing)
+    result["timing"] = timing
+    return result
+
+def daemon_stop(signum, frame):
+    '''
+    SIGTERM handler for the render daemon: raises SystemExit in the main thread so serve_forever() returns through its cleanup.
+    '''
+    raise SystemExit(0)
+
+def run_daemon(socket_name, workers, queue_size, outdir):
+    '''
+    Runs the render daemon on a Unix socket until it gets SIGTERM or SIGINT.
+    A pool of workers keeps PyMOL launched and the libraries imported, so a job only costs its render.
+    At most queue_size jobs wait for a free worker, any more are turned away as busy.
+    Either signal terminates the workers, shuts the manager down and removes the socket before the daemon exits.
+    '''
+    # which worker is running which job, so a hung one can be killed
+    manager = multiprocessing.Manager()
+    pool = multiprocessing.Pool(workers, initializer=pymol_worker_init)
+    if os.path.exists(socket_name):
+        os.remove(socket_name)
+    server = SocketServer.ThreadingUnixStreamServer(socket_name, DaemonHandler)
+    server.daemon_threads = True
+    server.pool = pool
+    server.running = manager.dict()
+    server.workers = workers
+    server.queue_size = queue_size
+    server.outdir = outdir
+    print "Render daemon listening on "+socket_name+" with "+str(workers)+" PyMOL workers and a queue of "+str(queue_size)+".."
+    # set after the pool and manager have started so their processes keep the default handler and pool.terminate() still stops them
+    signal.signal(signal.SIGTERM, daemon_stop)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        pool.terminate()
+        manager.shutdown()
+        os.remove(socket_name)
+    return None
+
+def daemon_request(socket_name, request):
+    '''
+    The thin client: sends one request to the render daemon and returns its reply.
+    '''
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_name)
+    try:
+        client.sendall(json.dumps(request)+"\n")
+        reply = client.makefile("r").readline()
+    finally:
+        client.close()
+    if not reply:
+        raise IOError("The render daemon on "+socket_name+" closed the connection without replying")
+    return json.loads(reply)
 
 #########################################################################################
 ############################       END FUNCTIONS      ###################################
@@ -465,70 +3635,151 @@ def canvas(image_name, info_dict):
 ################################       BODY       #######################################
 #########################################################################################
 # This is the "start" of the script.
-    
-# Handle commoand line arguments
-args = parse_args()
-print "Running analysis with the following inputs.. "
-print args
-ray = args.do_ray
-view = args.do_view
-palette = args.palette
-
-# need to add this line as pymol.png wants 0 or 1 not bool
-if ray == True:
-    do_ray = 1
-if ray == False:
-    do_ray = 0
-
-# If no palette is requested, use the default colours at the start of the script.
-if palette != None:
-    colourSet = load_palette(colourSet, palette)
-else:
-    None
-
-# This creates a new session of PyMOL and runs my favourite viewing parameters for PyMOL
-# These parameters can be seen in def intialisePymol() function above
-initialisePymol()
-
-# Fetch the mmcif file of the structure from RCSB
-pymol.cmd.fetch('6r0e', name="complex", type='cif')
-
-# sort the chains into objects
-chains = chains_dict.keys()
-
-print colourSet
-
-# load the different chains, colour them and create objects out of each chain
-for chain in chains:
-    pymol.cmd.select(chain, selection="complex and chain "+chains_dict[chain])
-
-    if colourSet[chain][0] == "#":
-        set_new_colour(chain+"_colour", hex_to_fraction(colourSet[chain]))
+
+def main():
+    '''
+    Handles the command line arguments and makes the artwork for 6R0E, or for every entry of a --batch manifest.
+    '''
+    global colourSet, ray_timeout, render_cache_dir, render_cache_size, structure_store_dir, offline, tile_size, tile_check
+    global canvas_compositor, compare_compositors, output_formats, warm_start, profiling, profile_dumps, render_budget, detail_level
+    global strip_output, strip_rows, encode_mode, encode_threads
+
+    # Handle commoand line arguments
+    args = parse_args()
+    print "Running analysis with the following inputs.. "
+    print args
+    ray = args.do_ray
+    view = args.do_view
+    palette = args.palette
+    ray_timeout = args.ray_timeout
+    render_cache_dir = args.cache_dir
+    render_cache_size = args.cache_size
+    warm_start = args.warm_start
+    if args.budget != None:
+        render_budget = args.budget
+    if args.detail != None:
+        detail_level = args.detail
+    elif args.budget != None:
+        detail_level = "auto"
+    profiling = args.profile
+    profile_dumps = args.profile and args.profile_dump
+    structure_store_dir = args.store
+    canvas_compositor = args.compositor
+    compare_compositors = args.compare_canvas
+    output_formats = args.formats.split(",")
+    strip_output = args.strips
+    strip_rows = args.strip_rows
+    encode_mode = args.encode
+    encode_threads = args.encode_threads
+    offline = args.offline
+
+    # Add local files to the structure store, i.e. to prepare an air-gapped render node
+    if args.store_add != None:
+        for file_name in args.store_add:
+            pdb_id = os.path.basename(file_name).split(".")[0]
+            entry = store_add(structure_store_dir, pdb_id, file_name)
+            print "Added "+pdb_id+" to "+entry["path"]
+        sys.exit(0)
+
+    # need to add this line as pymol.png wants 0 or 1 not bool
+    if ray == True:
+        do_ray = 1
+    if ray == False:
+        do_ray = 0
+
+    # Recolour previously rendered masks with combinations of the palette, no PyMOL needed
+    if args.explore != None:
+        if palette == None or not os.path.exists("complex_masks.npz"):
+            print "--explore needs a --palette and the complex_masks.npz made by a --ray --masks run"
+            sys.exit(1)
+        explore_palettes(load_masks("complex_masks.npz"), palette, "palette_explore", args.explore)
+        sys.exit(0)
+
+    # If no palette is requested, use the default colours at the start of the script.
+    if palette != None:
+        colourSet = load_palette(colourSet, palette)
     else:
-        set_new_colour(chain+"_colour", colourSet[chain])
-    pymol.cmd.color(chain+"_colour", chain)
-    pymol.cmd.create(chain+"_obj", selection=chain)
-
-pymol.cmd.select("HLA_a1a2", selection="complex and chain "+chains_dict["HLAA"]+" and resi 46-78 or complex and chain "+chains_dict["HLAB"]+" and resi 54-91")
-pymol.cmd.create("HLA_a1a2_obj", selection="HLA_a1a2")
-
-# generate the image of the structure using PyMOL
-structure_layer("complex", do_ray)
-
-# Parse the info from the mmcif file to create the info for the plaque
-structure_info = parse_pdb_info('6r0e.cif')
-
-# Generate the canvas, place the PyMOL image onto the canvas and draw the background and plaque
-canvas("complex_image.png", structure_info)
-
-###########
-# This is the end. We finally want to save the PyMOL session file and quit pymol. 
-# If we have asked to view the results in PyMOL, we will finish by opening up the session file.
-###########
-pymol.cmd.save("6R0E_artwork.pse")
-pymol.cmd.quit()
-if view == True:
-    subprocess.call(["pymol", "6R0E_artwork.pse"])
+        None
+
+    # Hand the job to a running render daemon rather than starting PyMOL here
+    if args.client != None:
+        if args.stats:
+            request = {"command" : "stats"}
+        else:
+            job = {"id" : entry_id, "chains" : chains_dict, "view" : complex_view, "colours" : colourSet, "transparency" : transparencySet, "formats" : output_formats}
+            request = {"command" : "render", "job" : job, "ray" : bool(do_ray), "outdir" : os.path.abspath(args.outdir)}
+        response = daemon_request(args.client, request)
+        print json.dumps(response, indent=2)
+        sys.exit(0 if response["status"] == "done" else 1)
+
+    if args.daemon != None:
+        run_daemon(args.daemon, args.workers, args.queue_size, args.outdir)
+        sys.exit(0)
+
+    # Batch jobs are handed to a pool of PyMOL workers, each of which runs make_artwork()
+    if args.batch != None:
+        if args.tiles:
+            print "--tiles is ignored with --batch, the entries are already rendered in parallel."
+        if not do_ray and render_cache_dir == None:
+            print "--no_ray with --batch reuses the cached renders of the entries, so it cannot be used with --no_cache"
+            sys.exit(1)
+        results = run_batch(load_manifest(args.batch), do_ray, args.workers, args.outdir)
+        failed = [result for result in results if result["status"] != "done"]
+        sys.exit(1 if failed else 0)
+
+    # Animation frames are rendered by a pool of PyMOL workers, which has to be started before PyMOL is launched here
+    if args.animate != None:
+        start_render_pool(args.workers)
+        try:
+            make_animation(entry_id, chains_dict, colourSet, complex_view, outdir=args.outdir, mode=args.animate,
+                           frames=args.frames, file_format=args.animation_format, timeout=ray_timeout)
+        finally:
+            render_pool.terminate()
+        pymol.cmd.quit()
+        sys.exit(0)
+
+    # Several views and sizes from one scene, ray traced in parallel by a pool of PyMOL workers started before PyMOL is launched here
+    if args.views != None or args.sizes != None:
+        views = args.views.split(",") if args.views != None else ["complex"]
+        sizes = args.sizes.split(",") if args.sizes != None else ["poster"]
+        unknown = [size for size in sizes if size not in output_sizes]
+        if unknown:
+            print "Unknown size "+", ".join(unknown)+", choose from "+", ".join(sorted(output_sizes))
+            sys.exit(1)
+        if do_ray and args.workers > 1:
+            start_render_pool(args.workers)
+        try:
+            outputs = make_renders(entry_id, chains_dict, colourSet, views, sizes, do_ray, outdir=args.outdir, formats=output_formats)
+        finally:
+            if render_pool != None:
+                render_pool.terminate()
+        print json.dumps(outputs, indent=2, sort_keys=True)
+        pymol.cmd.quit()
+        sys.exit(0)
+
+    # the tile workers have to be started before PyMOL is launched in this process
+    if args.tiles and do_ray:
+        tile_size = args.tile_size
+        tile_check = args.tile_check
+        start_render_pool(args.tile_workers)
+
+    outputs = make_artwork(entry_id, chains_dict, colourSet, complex_view, do_ray, masks=args.masks)
+
+    ###########
+    # This is the end. We finally want to quit pymol. 
+    # If we have asked to view the results in PyMOL, we will finish by opening up the session file.
+    ###########
+    if render_pool != None:
+        render_pool.terminate()
+    pymol.cmd.quit()
+    if view == True:
+        if outputs["session"] == None:
+            print "The render came from the cache so there is no session to view. Rerun with --no_cache."
+        else:
+            subprocess.call(["pymol", outputs["session"]])
+
+if __name__ == "__main__":
+    main()
 
 #########################################################################################
 #################################     END     ###########################################
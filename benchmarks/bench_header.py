@@ -0,0 +1,92 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Benchmarks the streaming header reader used by parse_pdb_info() against Biopython's MMCIF2Dict.
+
+Each parser is run in its own process so that the peak memory of one does not hide the other.
+--scale makes a very large entry out of each file by repeating its _atom_site rows, i.e. to look like a capsid or ribosome.
+
+    python benchmarks/bench_header.py structure_store/6r0e.cif.gz --scale 50
+"""
+
+import os
+import sys
+import time
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+import pymol_standin
+# the header reader does not need PyMOL, the stand-in is used if it is not installed
+artwork = pymol_standin.load_artwork(os.path.join(here, "..", "6R0E_artwork.py"), use_pymol=True)
+
+
+def scale_atom_site(file_name, scale):
+    '''
+    Writes a copy of an mmCIF file with every _atom_site row repeated scale times and returns its file name.
+    '''
+    handle, scaled_name = tempfile.mkstemp(suffix=".cif")
+    with os.fdopen(handle, "w") as target:
+        in_atom_site = False
+        rows = []
+        for line in artwork.open_structure(file_name):
+            if line.startswith("_atom_site."):
+                in_atom_site = True
+            elif in_atom_site and (line.startswith("#") or line.startswith("_") or line.startswith("loop_")):
+                for i in xrange(scale - 1):
+                    target.writelines(rows)
+                in_atom_site = False
+            elif in_atom_site:
+                rows.append(line)
+            target.write(line)
+    return scaled_name
+
+
+def run_parser(job):
+    '''
+    Parses one file with one parser and returns the time taken, the peak memory in MB and the parsed info.
+    '''
+    file_name, parser = job
+    start = time.time()
+    info = artwork.parse_pdb_info(file_name, parser=parser)
+    seconds = time.time() - start
+    return seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0, info
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('files', nargs='+', help='mmCIF files, optionally gzip compressed.')
+    parser.add_argument('--scale', type=int, default=1, help='Repeat the _atom_site rows this many times to make a very large entry.')
+    parser.add_argument('--repeats', type=int, default=3, help='Best of this many runs is reported.')
+    args = parser.parse_args()
+
+    print "%-30s %-10s %10s %10s" % ("file", "parser", "seconds", "peak MB")
+    for file_name in args.files:
+        bench_name = file_name
+        if args.scale > 1:
+            bench_name = scale_atom_site(file_name, args.scale)
+        results = {}
+        for parser_name in ["biopython", "stream"]:
+            runs = []
+            for i in xrange(args.repeats):
+                # a fresh process each time so peak memory is per parser
+                pool = multiprocessing.Pool(1, maxtasksperchild=1)
+                runs.append(pool.apply(run_parser, ((bench_name, parser_name),)))
+                pool.close()
+                pool.join()
+            seconds = min(run[0] for run in runs)
+            peak = max(run[1] for run in runs)
+            results[parser_name] = runs[0][2]
+            print "%-30s %-10s %10.3f %10.1f" % (os.path.basename(file_name)+" x"+str(args.scale), parser_name, seconds, peak)
+        if results["biopython"] != results["stream"]:
+            print "MISMATCH: the parsers disagree for "+file_name
+            sys.exit(1)
+        if bench_name != file_name:
+            os.remove(bench_name)
+
+
+if __name__ == "__main__":
+    main()
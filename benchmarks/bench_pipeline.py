@@ -0,0 +1,266 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Benchmarks the stages of the artwork pipeline offline and compares the results against a saved baseline.
+
+The structures are the synthetic fixtures in fixtures.py (and the real 6R0E if it is in the structure store).
+Without PyMOL, or unless --pymol is given, PyMOL is replaced by the stand-in in pymol_standin.py so the header parser,
+the chain set up, the canvas and the output encoders are timed on their own. With --pymol and a real PyMOL the structure is ray traced too.
+Each benchmark is run in a fresh process, the best time of --repeats runs and the peak memory are kept.
+
+    python benchmarks/bench_pipeline.py run --output benchmarks/baselines/my_machine.json
+    python benchmarks/bench_pipeline.py compare benchmarks/baselines/my_machine.json current.json --threshold 0.1
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import multiprocessing
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+import fixtures
+import pymol_standin
+
+schema = 1
+
+# set up in main(), inherited by the benchmark processes
+artwork = None
+
+
+def structure_info(name):
+    '''
+    The plaque info of a fixture.
+    '''
+    return artwork.parse_pdb_info(fixtures.fixture_path(name))
+
+
+def structure_image():
+    '''
+    A synthetic structure layer the size of the real one, as a float RGBA array like plt.imread returns.
+    '''
+    width = artwork.length_to_pixels(artwork.image_width, artwork.image_dpi)
+    height = artwork.length_to_pixels(artwork.image_height, artwork.image_dpi)
+    return pymol_standin.synthetic_render(width, height) / 255.0
+
+
+def bench_parse(name, scratch):
+    artwork.parse_pdb_info(fixtures.fixture_path(name))
+
+
+def bench_chains(name, scratch):
+    roles = fixtures.fixture_roles(name)
+    colours = dict((role, "#808080") for role in roles)
+    info = structure_info(name)
+    artwork.initialisePymol()
+    start = time.time()
+    artwork.pymol.cmd.load(fixtures.fixture_path(name), "complex")
+    artwork.setup_chains("complex", roles, colours, info["entities"])
+    return time.time() - start
+
+
+def bench_canvas(name, scratch):
+    image = structure_image()
+    info = structure_info(name)
+    start = time.time()
+    artwork.draw_page(image, info, artwork.colourSet, "numpy")
+    return time.time() - start
+
+
+def bench_canvas_cached(name, scratch):
+    image = structure_image()
+    info = structure_info(name)
+    # the first drawing fills the plaque cache
+    artwork.draw_page(image, info, artwork.colourSet, "numpy")
+    start = time.time()
+    artwork.draw_page(image, info, artwork.colourSet, "numpy")
+    return time.time() - start
+
+
+def bench_encoder(formats, mode="default"):
+    def bench(name, scratch):
+        artwork.encode_mode = mode
+        page = artwork.draw_page(structure_image(), structure_info(name), artwork.colourSet, "numpy")
+        start = time.time()
+        artwork.write_outputs(page, os.path.join(scratch, "canvas"), formats)
+        return time.time() - start
+    return bench
+
+
+def bench_strips(name, scratch):
+    layers = artwork.canvas_layers(structure_image(), structure_info(name), artwork.colourSet)
+    start = time.time()
+    artwork.write_strips(layers, os.path.join(scratch, "canvas"), ["png", "pdf", "tiff"])
+    return time.time() - start
+
+
+def bench_ray(name, scratch):
+    store = os.path.join(scratch, "store")
+    entry = artwork.store_add(store, name, fixtures.fixture_path(name))
+    artwork.initialisePymol()
+    artwork.pymol.cmd.load(entry["path"], "complex")
+    roles = fixtures.fixture_roles(name)
+    artwork.setup_chains("complex", roles, dict((role, "#808080") for role in roles), entry["header"]["entities"])
+    artwork.show_structure(roles.keys(), {})
+    artwork.pymol.cmd.orient()
+    start = time.time()
+    artwork.rayTime(os.path.join(scratch, "ray.png"), 1)
+    return time.time() - start
+
+
+# name, function, whether it is run for every fixture or only the first, whether it needs the real PyMOL
+BENCHMARKS = [  ("parse_pdb_info",      bench_parse,                    True,   False),
+                ("setup_chains",        bench_chains,                   True,   False),
+                ("canvas",              bench_canvas,                   False,  False),
+                ("canvas_cached_plaque",bench_canvas_cached,            False,  False),
+                ("encode_png_pdf",      bench_encoder(["png", "pdf"]),  False,  False),
+                ("encode_png_draft",    bench_encoder(["png"], "draft"),    False,  False),
+                ("encode_png_archival", bench_encoder(["png"], "archival"), False,  False),
+                ("encode_tiff",         bench_encoder(["tiff"]),        False,  False),
+                ("encode_bigtiff",      bench_encoder(["bigtiff"]),     False,  False),
+                ("strips_png_pdf_tiff", bench_strips,                   False,  False),
+                ("ray",                 bench_ray,                      True,   True)
+             ]
+
+
+def run_benchmark(job):
+    '''
+    Runs one benchmark on one fixture in a benchmark process. Returns the seconds taken and the peak memory in MB.
+    A benchmark can return the seconds of just the part it times, otherwise the whole call is timed.
+    '''
+    name, fixture = job
+    function = dict((benchmark[0], benchmark[1]) for benchmark in BENCHMARKS)[name]
+    scratch = tempfile.mkdtemp()
+    # every run starts with empty caches
+    artwork.render_cache_dir = None
+    artwork.plaque_cache.clear()
+    try:
+        start = time.time()
+        seconds = function(fixture, scratch)
+        if seconds == None:
+            seconds = time.time() - start
+    finally:
+        shutil.rmtree(scratch)
+    return seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run(args):
+    '''
+    Runs every benchmark and writes the results as json.
+    '''
+    names = fixtures.fixture_names()
+    if args.fixtures:
+        names = [name for name in names if name in args.fixtures.split(",")]
+    only = args.only.split(",") if args.only else None
+
+    results = {}
+    print "%-22s %-14s %10s %10s" % ("benchmark", "fixture", "seconds", "peak MB")
+    for benchmark, function, every_fixture, needs_pymol in BENCHMARKS:
+        if only and benchmark not in only:
+            continue
+        if needs_pymol and getattr(artwork.pymol, "standin", False):
+            print "%-22s skipped, needs PyMOL (run with --pymol)" % benchmark
+            continue
+        for name in (names if every_fixture else names[:1]):
+            runs = []
+            for i in xrange(args.repeats):
+                # a fresh process each time so the peak memory is for this benchmark alone
+                pool = multiprocessing.Pool(1, maxtasksperchild=1)
+                runs.append(pool.apply(run_benchmark, ((benchmark, name),)))
+                pool.close()
+                pool.join()
+            seconds = [run[0] for run in runs]
+            results[benchmark+"/"+name] = {"seconds" : min(seconds), "runs" : seconds, "peak_mb" : max(run[1] for run in runs)}
+            print "%-22s %-14s %10.3f %10.1f" % (benchmark, name, min(seconds), results[benchmark+"/"+name]["peak_mb"])
+
+    report = {  "schema"    :   schema,
+                "created"   :   time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "machine"   :   platform.node(),
+                "python"    :   platform.python_version(),
+                "numpy"     :   artwork.np.__version__,
+                "matplotlib":   artwork.matplotlib.__version__,
+                "pymol"     :   str(artwork.pymol.cmd.get_version()[0]),
+                "repeats"   :   args.repeats,
+                "results"   :   results
+             }
+    if args.output:
+        directory = os.path.dirname(os.path.abspath(args.output))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(args.output, "w") as handle:
+            json.dump(report, handle, indent=2, sort_keys=True)
+        print "Results written to "+args.output
+    return report
+
+
+def compare(args):
+    '''
+    Compares two results files and flags every benchmark which got slower by more than the threshold, or used more than the threshold more memory.
+    Differences below --min_seconds are ignored as noise. Exits with 1 if anything regressed.
+    '''
+    with open(args.baseline) as handle:
+        baseline = json.load(handle)
+    with open(args.current) as handle:
+        current = json.load(handle)
+    if baseline["machine"] != current["machine"]:
+        print "Warning: the baseline is from "+baseline["machine"]+" and the results from "+current["machine"]+", timings may not be comparable"
+
+    regressions = []
+    print "%-38s %10s %10s %8s %10s %10s" % ("benchmark", "baseline", "current", "ratio", "base MB", "peak MB")
+    for key in sorted(set(baseline["results"]) | set(current["results"])):
+        if key not in baseline["results"] or key not in current["results"]:
+            print "%-38s only in %s" % (key, "the baseline" if key in baseline["results"] else "the current results")
+            continue
+        old = baseline["results"][key]
+        new = current["results"][key]
+        ratio = new["seconds"] / max(old["seconds"], 1e-9)
+        flags = []
+        if new["seconds"] > old["seconds"] * (1 + args.threshold) and new["seconds"] - old["seconds"] > args.min_seconds:
+            flags.append("SLOWER")
+        if new["peak_mb"] > old["peak_mb"] * (1 + args.threshold) and new["peak_mb"] - old["peak_mb"] > args.min_mb:
+            flags.append("MORE MEMORY")
+        if flags:
+            regressions.append(key)
+        print "%-38s %10.3f %10.3f %8.2f %10.1f %10.1f %s" % (key, old["seconds"], new["seconds"], ratio, old["peak_mb"], new["peak_mb"], " ".join(flags))
+
+    if regressions:
+        print str(len(regressions))+" regression(s) over "+'%.0f' % (100 * args.threshold)+"%"
+        sys.exit(1)
+    print "No regressions"
+
+
+def main():
+    global artwork
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command")
+
+    run_parser = commands.add_parser("run", help="Run the benchmarks.")
+    run_parser.add_argument('--output', help='Write the results to this json file, i.e. to keep as a baseline.')
+    run_parser.add_argument('--repeats', type=int, default=3, help='Best of this many runs is reported.')
+    run_parser.add_argument('--fixtures', help='Comma separated fixtures to run, from '+", ".join(fixtures.FIXTURES.keys())+' and 6r0e.')
+    run_parser.add_argument('--only', help='Comma separated benchmarks to run, from '+", ".join(benchmark[0] for benchmark in BENCHMARKS)+'.')
+    run_parser.add_argument('--pymol', action='store_true', help='Use the real PyMOL if it is installed, and ray trace.')
+
+    compare_parser = commands.add_parser("compare", help="Compare results against a baseline.")
+    compare_parser.add_argument('baseline', help='Baseline results json.')
+    compare_parser.add_argument('current', help='Current results json.')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='Fraction slower (or more memory) that counts as a regression.')
+    compare_parser.add_argument('--min_seconds', type=float, default=0.02, help='Ignore time differences smaller than this.')
+    compare_parser.add_argument('--min_mb', type=float, default=20.0, help='Ignore memory differences smaller than this.')
+
+    args = parser.parse_args()
+    if args.command == "compare":
+        compare(args)
+        return
+    artwork = pymol_standin.load_artwork(os.path.join(here, "..", "6R0E_artwork.py"), use_pymol=args.pymol)
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
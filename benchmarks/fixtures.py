@@ -0,0 +1,139 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Synthetic mmCIF fixtures for the benchmarks, so they run offline.
+
+Each fixture has the header categories the plaque is made from and an _atom_site loop with a few atoms per residue along a helix per chain.
+They are written into benchmarks/fixtures the first time they are asked for and are the same every time.
+The real 6R0E is used as well when it is in the structure store (python 6R0E_artwork.py --store_add 6r0e.cif.gz).
+
+    python benchmarks/fixtures.py
+"""
+
+import os
+import math
+import string
+import collections
+
+here = os.path.dirname(os.path.abspath(__file__))
+fixture_dir = os.path.join(here, "fixtures")
+store_dir = os.path.join(here, "..", "structure_store")
+
+# atoms written per residue, about what a real protein has on average
+atoms_per_residue = 8
+
+
+def chain_ids(count):
+    '''
+    count chain ids A, B, .., Z, AA, AB, ..
+    '''
+    letters = string.ascii_uppercase
+    ids = list(letters)
+    ids += [first + second for first in letters for second in letters]
+    return ids[:count]
+
+
+# name: chains as (chain id, entity id, residues), entities as (entity id, type) and the roles the chains are grouped into
+FIXTURES = collections.OrderedDict()
+
+# the size and chain names of 6R0E: HLA heavy chain, b2m, peptide and the two TCR chains
+FIXTURES["6r0e_like"] = {   "chains"    :   [("AAA", "1", 275), ("BBB", "2", 99), ("CCC", "3", 9), ("DDD", "4", 205), ("EEE", "5", 245)],
+                            "entities"  :   [("1", "polypeptide(L)"), ("2", "polypeptide(L)"), ("3", "polypeptide(L)"), ("4", "polypeptide(L)"), ("5", "polypeptide(L)")],
+                            "roles"     :   {"HLAA" : "AAA", "HLAB" : "BBB", "peptide" : "CCC", "TCRA" : "DDD", "TCRB" : "EEE"}
+                        }
+
+# a small virus capsid: 60 copies of one coat protein
+FIXTURES["capsid_60"] = {   "chains"    :   [(chain, "1", 250) for chain in chain_ids(60)],
+                            "entities"  :   [("1", "polypeptide(L)")],
+                            "roles"     :   {"capsid" : "type:polypeptide(L)", "marked" : "A,B,C"}
+                        }
+
+# a big assembly of several entities including RNA
+FIXTURES["assembly_240"] = {"chains"    :   [(chain, str(1 + i % 4), 150) for i, chain in enumerate(chain_ids(240))],
+                            "entities"  :   [("1", "polypeptide(L)"), ("2", "polypeptide(L)"), ("3", "polypeptide(L)"), ("4", "polyribonucleotide")],
+                            "roles"     :   {"protein" : "type:polypeptide*", "rna" : "entity:4", "first" : "A*"}
+                        }
+
+
+def write_fixture(name, file_name):
+    '''
+    Writes the synthetic mmCIF file of a fixture.
+    '''
+    fixture = FIXTURES[name]
+    with open(file_name, "w") as handle:
+        handle.write("data_%s\n#\n" % name.upper())
+        handle.write("_entry.id %s\n#\n" % name.upper())
+        handle.write("_citation.id primary\n")
+        handle.write("_citation.title 'A synthetic %s structure for benchmarking the artwork pipeline with a title long enough to wrap over more than one line of the plaque'\n" % name.replace("_", " "))
+        handle.write("_citation.journal_abbrev 'J Bench'\n")
+        handle.write("_citation.year 2020\n#\n")
+        handle.write("loop_\n_citation_author.citation_id\n_citation_author.name\n_citation_author.ordinal\n")
+        for i in xrange(24):
+            handle.write("primary 'Author%s, %s.' %d\n" % (chr(65 + i % 26) * (1 + i % 3), chr(65 + i % 26), i + 1))
+        handle.write("#\n_reflns.entry_id %s\n_reflns.d_resolution_high 2.50\n#\n" % name.upper())
+        handle.write("_symmetry.entry_id %s\n_symmetry.space_group_name_H-M 'P 21 21 21'\n#\n" % name.upper())
+        handle.write("_cell.entry_id %s\n_cell.length_a 80.123\n_cell.length_b 95.456\n_cell.length_c 130.789\n" % name.upper())
+        handle.write("_cell.angle_alpha 90.00\n_cell.angle_beta 90.00\n_cell.angle_gamma 90.00\n#\n")
+
+        handle.write("loop_\n_entity_poly.entity_id\n_entity_poly.type\n_entity_poly.pdbx_strand_id\n")
+        for entity, kind in fixture["entities"]:
+            strands = ",".join(chain for chain, chain_entity, residues in fixture["chains"] if chain_entity == entity)
+            handle.write("%s %s %s\n" % (entity, kind, strands))
+        handle.write("#\n")
+
+        columns = ["group_PDB", "id", "type_symbol", "label_atom_id", "label_comp_id", "label_asym_id", "label_entity_id", "label_seq_id",
+                   "Cartn_x", "Cartn_y", "Cartn_z", "occupancy", "B_iso_or_equiv", "auth_seq_id", "auth_asym_id", "pdbx_PDB_model_num"]
+        handle.write("loop_\n" + "".join("_atom_site.%s\n" % column for column in columns))
+        atom = 0
+        for number, (chain, entity, residues) in enumerate(fixture["chains"]):
+            # each chain is a helix of its own, the chains are laid out on a ring
+            centre_x = 60.0 * math.cos(number * 2 * math.pi / len(fixture["chains"]))
+            centre_y = 60.0 * math.sin(number * 2 * math.pi / len(fixture["chains"]))
+            for residue in xrange(1, residues + 1):
+                for i in xrange(atoms_per_residue):
+                    atom += 1
+                    angle = math.radians(100.0 * residue + 45.0 * i)
+                    x = centre_x + 2.3 * math.cos(angle) + 0.3 * i
+                    y = centre_y + 2.3 * math.sin(angle)
+                    z = 1.5 * residue + 0.2 * i
+                    handle.write("ATOM %d C C%d ALA %s %s %d %.3f %.3f %.3f 1.00 30.00 %d %s 1\n" % (atom, i, chain, entity, residue, x, y, z, residue, chain))
+        handle.write("#\n")
+    return file_name
+
+
+def fixture_path(name):
+    '''
+    The file name of a fixture, written first if it is not there yet. "6r0e" is the real entry from the structure store.
+    '''
+    if name == "6r0e":
+        return os.path.join(store_dir, "6r0e.cif.gz")
+    if not os.path.isdir(fixture_dir):
+        os.makedirs(fixture_dir)
+    file_name = os.path.join(fixture_dir, name+".cif")
+    if not os.path.exists(file_name):
+        write_fixture(name, file_name)
+    return file_name
+
+
+def fixture_roles(name):
+    '''
+    The chains dict a fixture is set up with.
+    '''
+    if name == "6r0e":
+        return FIXTURES["6r0e_like"]["roles"]
+    return FIXTURES[name]["roles"]
+
+
+def fixture_names():
+    '''
+    Every fixture, with the real 6R0E first if it is in the structure store.
+    '''
+    names = list(FIXTURES.keys())
+    if os.path.exists(fixture_path("6r0e")):
+        names.insert(0, "6r0e")
+    return names
+
+
+if __name__ == "__main__":
+    for name in fixture_names():
+        print name, fixture_path(name)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+A lightweight stand-in for PyMOL so the parts of the pipeline around it can be benchmarked on machines without PyMOL.
+
+It keeps track of objects and selections as atom counts per chain, which is all setup_chains() and the level of detail need,
+and pymol.cmd.png writes a synthetic render of the size asked for. Nothing is really drawn, so it says nothing about ray tracing speed.
+install() has to be called before 6R0E_artwork.py is loaded.
+"""
+
+import sys
+import imp
+import collections
+
+import numpy as np
+
+
+def synthetic_render(width, height):
+    '''
+    A uint8 RGBA image which looks a bit like a render: an opaque shaded blob in the middle on a transparent background with soft edges.
+    '''
+    rows, columns = np.ogrid[0:height, 0:width]
+    distance = np.hypot((columns - width / 2.0) / (width / 2.5), (rows - height / 2.0) / (height / 2.5))
+    image = np.zeros((height, width, 4), np.uint8)
+    shade = np.clip(1.0 - distance, 0.0, 1.0)
+    image[:, :, 0] = (40 + 180 * shade).astype(np.uint8)
+    image[:, :, 1] = (90 + 120 * shade).astype(np.uint8)
+    image[:, :, 2] = (100 + 100 * shade).astype(np.uint8)
+    image[:, :, 3] = (np.clip((1.0 - distance) * 20.0, 0.0, 1.0) * 255).astype(np.uint8)
+    return image
+
+
+class StandinCmd(object):
+    '''
+    The parts of pymol.cmd used by 6R0E_artwork.py.
+    '''
+    def __init__(self):
+        self.artwork = None
+        self.reinitialize()
+
+    def reinitialize(self):
+        self.objects = collections.OrderedDict()
+        self.selections = collections.OrderedDict()
+        self.settings = {}
+        self.view = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, -100.0, 0.0, 0.0, 0.0, 80.0, 120.0, -20.0]
+
+    def load(self, file_name, name=None):
+        if file_name.endswith(".pse"):
+            return
+        counts = collections.OrderedDict()
+        columns = []
+        handle = self.artwork.open_structure(file_name)
+        try:
+            for line in handle:
+                if line.startswith("_atom_site."):
+                    columns.append(line.strip()[len("_atom_site."):])
+                elif line.startswith("ATOM") or line.startswith("HETATM"):
+                    chain = line.split()[columns.index("auth_asym_id")]
+                    counts[chain] = counts.get(chain, 0) + 1
+        finally:
+            handle.close()
+        self.objects[name] = counts
+
+    def evaluate(self, selection):
+        # only the kinds of selection the script makes: "name", "name and chain A+B", "name and resi 1-10" joined by "or"
+        result = collections.OrderedDict()
+        for part in selection.split(" or "):
+            terms = part.split(" and ")
+            counts = dict(self.objects.get(terms[0].strip()) or self.selections.get(terms[0].strip()) or {})
+            for term in terms[1:]:
+                term = term.strip()
+                if term.startswith("chain "):
+                    chains = term[len("chain "):].split("+")
+                    counts = dict((chain, count) for chain, count in counts.items() if chain in chains)
+                elif term.startswith("resi "):
+                    first, last = term[len("resi "):].split("-")
+                    counts = dict((chain, min(count, (int(last) - int(first) + 1) * 8)) for chain, count in counts.items())
+            for chain, count in counts.items():
+                result[chain] = result.get(chain, 0) + count
+        return result
+
+    def select(self, name, selection="", **kwargs):
+        self.selections[name] = self.evaluate(selection)
+
+    def create(self, name, selection="", **kwargs):
+        self.objects[name] = self.evaluate(selection)
+
+    def extract(self, name, selection="", **kwargs):
+        counts = self.evaluate(selection)
+        self.objects[name] = counts
+        # the atoms move out of the objects they were in
+        for other in self.objects:
+            if other != name:
+                for chain in counts:
+                    if chain in self.objects[other]:
+                        self.objects[other][chain] = max(0, self.objects[other][chain] - counts[chain])
+
+    def count_atoms(self, selection="all"):
+        return sum(self.evaluate(selection).values())
+
+    def get_chains(self, selection="all"):
+        return [chain for chain, count in self.evaluate(selection).items() if count]
+
+    def get_names(self, kind="objects"):
+        return list(self.selections if kind == "selections" else self.objects)
+
+    def set(self, name, value=None, selection=None, **kwargs):
+        self.settings[name] = value
+
+    def get(self, name, selection=None):
+        return self.settings.get(name, 0.0)
+
+    def set_view(self, view):
+        self.view = self.artwork.view_to_list(view)
+
+    def get_view(self):
+        return tuple(self.view)
+
+    def turn(self, axis, angle):
+        self.view = self.artwork.turn_view(self.view, axis, angle)
+
+    def png(self, file_name, width=0, height=0, dpi=-1, ray=0, **kwargs):
+        dpi = dpi if dpi > 0 else 150
+        pixels = synthetic_render(self.artwork.length_to_pixels(width, dpi), self.artwork.length_to_pixels(height, dpi))
+        self.artwork.write_png(file_name, pixels, self.artwork.png_idat(pixels, 1), dpi)
+
+    def save(self, file_name, *args, **kwargs):
+        with open(file_name, "w") as handle:
+            handle.write("pymol stand-in session\n")
+
+    def get_version(self):
+        return ("stand-in", 0.0, 0)
+
+    def set_color(self, *args, **kwargs):
+        pass
+
+    def color(self, *args, **kwargs):
+        pass
+
+    def show(self, *args, **kwargs):
+        pass
+
+    def hide(self, *args, **kwargs):
+        pass
+
+    def scene(self, *args, **kwargs):
+        pass
+
+    def cache(self, *args, **kwargs):
+        pass
+
+    def ray(self, *args, **kwargs):
+        pass
+
+    def sync(self, *args, **kwargs):
+        pass
+
+    def quit(self):
+        pass
+
+
+def install():
+    '''
+    Puts the stand-in in sys.modules as pymol. Returns it.
+    '''
+    pymol = imp.new_module("pymol")
+    pymol.cmd = StandinCmd()
+    pymol.finish_launching = lambda args=None: None
+    pymol.standin = True
+    sys.modules["pymol"] = pymol
+    return pymol
+
+
+def real_pymol_available():
+    '''
+    True if the real PyMOL can be imported.
+    '''
+    try:
+        imp.find_module("pymol")
+    except ImportError:
+        return False
+    return not getattr(sys.modules.get("pymol"), "standin", False)
+
+
+def load_artwork(file_name, use_pymol=False):
+    '''
+    Loads 6R0E_artwork.py as a module, with the stand-in in place of PyMOL unless use_pymol and PyMOL is there.
+    '''
+    if not (use_pymol and real_pymol_available()):
+        pymol = install()
+        artwork = imp.load_source("artwork", file_name)
+        pymol.cmd.artwork = artwork
+        return artwork
+    return imp.load_source("artwork", file_name)